@@ -1,11 +1,19 @@
 import os
-from flask import Flask, request, redirect, url_for, render_template, send_file, flash, jsonify
+from flask import Flask, Request, current_app, request, redirect, url_for, render_template, send_file, flash, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import tools
-import divider as dv
 import encrypter as enc
 import decrypter as dec
 import restore as rst
+import container
+import jobs
+import transfer
+import peer
+import piece_store
+import delta
+import upload
+import schedule
+import hashlib
 import socket
 import requests
 from requests.exceptions import RequestException
@@ -17,6 +25,8 @@ import logging
 from flask_cors import CORS
 import traceback
 import shutil
+import mimetypes
+import uuid
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -26,15 +36,43 @@ UPLOAD_FOLDER = './uploads/'
 UPLOAD_KEY = './key/'
 ALLOWED_EXTENSIONS = {'pem', 'txt', 'pdf', 'doc', 'docx', 'jpg', 'jpeg', 'png'}
 
+class StreamingRequest(Request):
+    """Requests whose body is handled as it streams in, never held whole"""
+    STREAMED = {'share_file', 'share_batch', 'receive_stream'}
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in self.STREAMED:
+            return current_app.config['MAX_STREAM_LENGTH']
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = StreamingRequest
 CORS(app, resources={r"/*": {"origins": "*"}})  # Enable CORS for all routes
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['UPLOAD_KEY'] = UPLOAD_KEY
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max body read whole (JSON, base64)
+app.config['MAX_STREAM_LENGTH'] = None  # Streamed uploads and transfers; None for no limit
+app.config['CRYPTO_WORKERS'] = os.cpu_count() or 1  # Pool size for per-piece encryption
+app.config['CHUNK_SIZE'] = None  # Piece size in bytes, None picks one from the file size
+app.config['RAW_PIECES'] = True  # Store the Fernet slot as raw AES-GCM instead of base64 tokens
+app.config['KEEP_CIPHERTEXT'] = True  # Keep received files encrypted and decrypt them on download
+app.config['JOB_WORKERS'] = 2  # Share/receive jobs running at once in the background
+app.config['MAX_PENDING_JOBS'] = 32  # Jobs allowed to wait for a worker
+app.config['PEER_PORT'] = 8000  # Port the peers' servers listen on
+app.config['SEND_WORKERS'] = 4  # Pieces in flight when pushing a file to a peer
+app.config['SEND_RETRIES'] = 5  # Rounds of resending missing pieces before a send fails
+app.config['TRANSFER_KEEP_SECONDS'] = 24 * 3600  # Unfinished incoming transfers are dropped after this
+app.config['CHUNKING'] = 'fixed'  # 'cdc' for content-defined, deduplicated pieces
+app.config['PIECE_STORE'] = piece_store.STORE  # Received content-defined pieces, stored once
+app.config['SENT_INDEX'] = delta.INDEX_DIR  # What each peer got last, for delta re-shares
+app.config['COMPRESSION'] = None  # 'zlib' or 'lzma' to compress compressible pieces before encryption
+app.config['CIPHER_SCHEDULE'] = 'benchmark'  # Policy for the order of algorithms, see schedule.POLICIES
 app.secret_key = os.urandom(24)
 
 # Create necessary directories with better error handling
-required_directories = [UPLOAD_FOLDER, UPLOAD_KEY, 'files', 'encrypted', 'restored_file', 'raw_data', 'received_files']
+RECEIVED_ENCRYPTED = 'received_encrypted'
+required_directories = [UPLOAD_FOLDER, UPLOAD_KEY, 'files', 'encrypted', 'restored_file', 'raw_data', 'received_files', RECEIVED_ENCRYPTED, tools.WORKSPACES, app.config['PIECE_STORE']]
 for directory in required_directories:
     try:
         os.makedirs(directory, exist_ok=True)
@@ -50,6 +88,25 @@ for directory in required_directories:
         logger.error(f"Error with directory {directory}: {str(e)}")
         # Don't exit, but log the error for debugging
 
+# Background share/receive jobs
+job_queue = jobs.JobQueue(workers=app.config['JOB_WORKERS'], max_pending=app.config['MAX_PENDING_JOBS'])
+
+# Pooled keep-alive connections to peers
+peer_client = peer.PeerClient(pool_size=app.config['SEND_WORKERS'] * 2, port=app.config['PEER_PORT'])
+
+def cipher_schedule():
+    """The schedule new archives are encrypted with; the benchmark runs once"""
+    return schedule.choose(app.config['CIPHER_SCHEDULE'], app.config['RAW_PIECES'])
+
+logger.debug(f"Cipher schedule ({app.config['CIPHER_SCHEDULE']}): {''.join(map(str, cipher_schedule()))}")
+
+# Content-defined pieces we hold, shared by all received archives
+pieces_held = piece_store.PieceStore(app.config['PIECE_STORE'])
+
+# Transfers pushed to us by peers, by transfer id
+incoming_transfers = {}
+incoming_lock = threading.Lock()
+
 # Store connected peers and their status
 connected_peers = {}
 peer_connections = {}
@@ -71,8 +128,7 @@ def get_local_ip():
 def test_peer_connection(peer_ip):
     """Test connection to a peer with better error handling"""
     try:
-        response = requests.get(f'http://{peer_ip}:8000/ping', timeout=5)
-        return response.status_code == 200
+        return peer_client.ping(peer_ip)
     except requests.exceptions.ConnectionError:
         logger.error(f"Connection error to peer {peer_ip}")
         return False
@@ -134,53 +190,182 @@ def safe_copy_file(src, dst):
         logger.error(f"Error copying file from {src} to {dst}: {str(e)}")
         return False
 
-def encrypt_file(file_path):
-    """Encrypt a file and return the key path"""
+def claim_received_name(filename, encrypted=False):
+    """Reserve filename, numbered if a received file of that name already exists
+
+    The name is claimed by creating its entry, so two receives running at
+    once can't both get it: the archive folder in RECEIVED_ENCRYPTED when
+    the ciphertext is kept, otherwise an empty file in received_files for
+    the decrypted file to be moved over.
+    """
+    if encrypted:
+        folder, other = RECEIVED_ENCRYPTED, 'received_files'
+    else:
+        folder, other = 'received_files', RECEIVED_ENCRYPTED
+    base_name, ext = os.path.splitext(filename)
+    final_filename = filename
+    counter = 1
+    while True:
+        path = os.path.join(folder, final_filename)
+        if not os.path.exists(os.path.join(other, final_filename)):
+            try:
+                if encrypted:
+                    os.makedirs(path)
+                else:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                pass
+            else:
+                # Names are shared with the other folder; if it was claimed
+                # there meanwhile, give this one up and try the next
+                if not os.path.exists(os.path.join(other, final_filename)):
+                    return final_filename
+                if encrypted:
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+        final_filename = f"{base_name}_{counter}{ext}"
+        counter += 1
+
+def move_received(path, filename):
+    """Move a decrypted file into received_files under a freshly claimed name; return the name"""
+    final_filename = claim_received_name(filename)
+    received_path = os.path.join('received_files', final_filename)
+    try:
+        shutil.move(path, received_path)
+    except BaseException:
+        safe_remove_file(received_path)
+        raise
+    return final_filename
+
+def keep_ciphertext(filename, workspace):
+    """Move the received archive out of the job workspace, still encrypted.
+
+    The entry gets the key/, raw_data/ and encrypted/ layout the decrypter
+    reads, so /download can decrypt it piece by piece later.
+    """
+    final_filename = claim_received_name(filename, encrypted=True)
+    entry = os.path.join(RECEIVED_ENCRYPTED, final_filename)
+    try:
+        for directory in ('key', 'raw_data', 'encrypted'):
+            shutil.move(workspace.path(directory), os.path.join(entry, directory))
+    except BaseException:
+        shutil.rmtree(entry, ignore_errors=True)
+        raise
+    logger.debug(f"Encrypted archive kept in: {entry}")
+    return final_filename
+
+def stream_decrypted(filename):
+    """Serve a kept archive, decrypting only the pieces the request needs"""
+    entry = os.path.join(RECEIVED_ENCRYPTED, filename)
+    meta = dec.read_meta(entry)
+    file_size = int(meta['file_size'])
+
+    start, stop, status = 0, file_size, 200
+    if request.range is not None:
+        requested = request.range.range_for_length(file_size)
+        if requested is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{file_size}'})
+        start, stop = requested
+        status = 206
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(stop - start),
+        'Content-Disposition': f'attachment; filename="{filename}"',
+    }
+    if status == 206:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{file_size}'
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return Response(stream_with_context(dec.iter_range(entry, start, stop, workers=app.config['CRYPTO_WORKERS'])),
+                    status=status, headers=headers, mimetype=mimetype)
+
+def iter_file_range(file_path, start, stop, block=1024 * 64):
+    """Yield bytes [start, stop) of a plain file on disk"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while start < stop:
+            data = f.read(min(block, stop - start))
+            if not data:
+                break
+            start += len(data)
+            yield data
+
+def check_archive(workspace):
+    """Return a received archive's metadata, refusing a file name that can't be restored safely"""
+    meta = dec.read_meta(workspace.root)
+    if 'batch' not in meta:
+        tools.restored_name(meta['File_Name'])
+    return meta
+
+def wants_background():
+    """True when the client asked for a job id instead of waiting for the result"""
+    return request.args.get('async', '').lower() in ('1', 'true', 'yes')
+
+def wants_binary():
+    """True when the client asked for the binary transfer stream instead of JSON"""
+    return request.args.get('format', '').lower() == 'binary'
+
+def run_job(job, workspace, fn, *args):
+    """Job body: run fn in the workspace; the queue removes it when the job ends"""
+    return fn(workspace, *args, progress=job.progress)
+
+def start_job(kind, workspace, fn, *args, hold=False):
+    """Hand the workspace over to a background job and answer with its id
+
+    With hold the workspace outlives a finished job, so its result can
+    point at files in it instead of carrying them.
+    """
+    workspace.detached = True
+    try:
+        job = job_queue.submit(kind, run_job, workspace, fn, *args, on_discard=workspace.cleanup,
+                               hold=workspace if hold else None)
+    except jobs.QueueFull as e:
+        workspace.detached = False
+        logger.warning(f"Rejected {kind} job: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    logger.debug(f"Started {kind} job {job.id}")
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job.id,
+        'status_url': url_for('job_status', job_id=job.id)
+    }), 202
+
+def encrypt_file(file_path, workspace, progress=None, known=None, source=None, size_hint=None):
+    """Encrypt a file inside the job workspace and return the key path
+
+    known holds the convergent keys of content-defined chapters the receiver
+    already has; they are left out of the archive. With source, an upload
+    still arriving, the file is encrypted from the stream as it is read.
+    """
     try:
         logger.debug(f"Starting encryption of file: {file_path}")
         
         # Ensure the file exists and is readable
-        if not os.path.exists(file_path):
-            raise Exception(f"Source file not found: {file_path}")
-        
-        if not os.access(file_path, os.R_OK):
-            raise Exception(f"Source file is not readable: {file_path}")
-            
-        file_size = os.path.getsize(file_path)
-        if file_size == 0:
-            raise Exception(f"Source file is empty: {file_path}")
-            
-        logger.debug(f"Source file verified - size: {file_size} bytes")
-        
-        # Since the file is already in the uploads directory (saved by Flask),
-        # we don't need to copy it again. Just verify it's there.
-        if not file_path.startswith(UPLOAD_FOLDER):
-            # If for some reason the file is not in uploads, copy it
-            filename = os.path.basename(file_path)
-            upload_path = os.path.join(UPLOAD_FOLDER, filename)
-            
-            if not safe_copy_file(file_path, upload_path):
-                raise Exception(f"Failed to copy file to uploads directory")
-            
-            logger.debug(f"File copied to uploads: {upload_path}")
-        else:
-            logger.debug(f"File already in uploads directory: {file_path}")
-        
-        # Clear any existing files in the necessary directories
-        try:
-            tools.empty_folder('files')
-            tools.empty_folder('encrypted')
-            tools.empty_folder('key')
-            logger.debug("Cleared working directories")
-        except Exception as e:
-            logger.warning(f"Error clearing folders: {str(e)}")
+        if source is None:
+            if not os.path.exists(file_path):
+                raise Exception(f"Source file not found: {file_path}")
+
+            if not os.access(file_path, os.R_OK):
+                raise Exception(f"Source file is not readable: {file_path}")
+
+            file_size = os.path.getsize(file_path)
+            if file_size == 0:
+                raise Exception(f"Source file is empty: {file_path}")
+
+            logger.debug(f"Source file verified - size: {file_size} bytes")
         
+        # The workspace belongs to this job only, so there is nothing left
+        # over from other jobs to clear
         # Encrypt the file
         try:
-            logger.debug("Starting divide process")
-            dv.divide()
-            logger.debug("Starting encryption process")
-            enc.encrypter()
+            logger.debug("Starting streaming divide and encryption process")
+            enc.encrypt_stream(file_path, workers=app.config['CRYPTO_WORKERS'],
+                               chunk_size=app.config['CHUNK_SIZE'],
+                               raw=app.config['RAW_PIECES'], root=workspace.root,
+                               progress=progress, cdc=app.config['CHUNKING'] == 'cdc',
+                               compress=app.config['COMPRESSION'], known=known,
+                               source=source, size_hint=size_hint, schedule=cipher_schedule())
             logger.debug("Encryption process completed")
         except Exception as e:
             logger.error(f"Error during encryption process: {str(e)}")
@@ -188,11 +373,11 @@ def encrypt_file(file_path):
         
         # Get the generated key
         try:
-            list_directory = tools.list_dir('key')
+            list_directory = tools.list_dir(workspace.path('key'))
             if not list_directory:
                 raise Exception("No key generated during encryption")
             
-            key_path = os.path.join('key', list_directory[0])
+            key_path = workspace.path('key', list_directory[0])
             
             # Verify key file exists and is not empty
             if not os.path.exists(key_path):
@@ -211,8 +396,28 @@ def encrypt_file(file_path):
         logger.error(f"Traceback: {traceback.format_exc()}")
         raise
 
-def decrypt_file(file_path, key_path):
-    """Decrypt a file using the provided key"""
+def encrypt_batch(file_paths, workspace, progress=None):
+    """Encrypt a batch of files with one key into one container; return the key path"""
+    try:
+        logger.debug(f"Starting batch encryption of {len(file_paths)} files")
+        enc.encrypt_batch(file_paths, workers=app.config['CRYPTO_WORKERS'],
+                          chunk_size=app.config['CHUNK_SIZE'],
+                          raw=app.config['RAW_PIECES'], root=workspace.root,
+                          progress=progress, compress=app.config['COMPRESSION'],
+                          schedule=cipher_schedule())
+    except Exception as e:
+        logger.error(f"Error during batch encryption: {str(e)}")
+        raise Exception(f"Encryption failed: {str(e)}")
+    return workspace.path('key', tools.list_dir(workspace.path('key'))[0])
+
+def encrypt_upload(file_path, workspace, progress=None, known=None):
+    """Encrypt one uploaded file, or a batch when given a list of paths"""
+    if isinstance(file_path, list):
+        return encrypt_batch(file_path, workspace, progress)
+    return encrypt_file(file_path, workspace, progress, known)
+
+def decrypt_file(file_path, key_path, workspace, progress=None):
+    """Decrypt a file inside the job workspace using the provided key"""
     try:
         logger.debug(f"Starting decryption of file: {file_path} with key: {key_path}")
         
@@ -225,32 +430,31 @@ def decrypt_file(file_path, key_path):
             raise Exception(f"Key file not found: {key_path}")
             
         # Verify files are not empty
-        if os.path.getsize(file_path) == 0:
+        if not len(container.open_pieces(file_path)):
             raise Exception("Encrypted file is empty")
         if os.path.getsize(key_path) == 0:
             raise Exception("Key file is empty")
             
-        # Clear any existing files in the necessary directories, EXCEPT raw_data
-        try:
-            tools.empty_folder('restored_file')
-        except Exception as e:
-            logger.warning(f"Error clearing restored_file folder: {str(e)}")
-        
-        # Decrypt the file
+        # Decrypt the file, writing pieces straight to their offsets when the
+        # metadata allows it and falling back to the separate restore pass
         try:
-            dec.decrypter()
-            rst.restore()
+            meta = dec.read_meta(workspace.root)
+            output = workspace.path('restored_file', tools.restored_name(meta['File_Name']))
+            if dec.decrypter(workers=app.config['CRYPTO_WORKERS'], output=output,
+                             root=workspace.root, progress=progress) is None:
+                stats = rst.restore(workspace.root)
+                logger.debug(f"Restored {stats['bytes']} bytes at {stats['throughput']:.1f} MB/s ({stats['method']})")
         except Exception as e:
             logger.error(f"Error during decryption process: {str(e)}")
             raise Exception(f"Decryption failed: {str(e)}")
         
         # Get the decrypted file
         try:
-            list_directory = tools.list_dir('restored_file')
+            list_directory = tools.list_dir(workspace.path('restored_file'))
             if not list_directory:
                 raise Exception("No file restored after decryption")
             
-            decrypted_path = os.path.join('restored_file', list_directory[0])
+            decrypted_path = workspace.path('restored_file', list_directory[0])
             
             # Verify decrypted file exists and is not empty
             if not os.path.exists(decrypted_path) or os.path.getsize(decrypted_path) == 0:
@@ -292,7 +496,7 @@ def test_connection(ip):
         if test_peer_connection(ip):
             # Notify the peer about the connection
             try:
-                response = requests.post(f'http://{ip}:8000/peer-connected', 
+                response = peer_client.request('POST', ip, '/peer-connected',
                             json={'peer': get_local_ip()},
                             timeout=5)
                 if response.status_code == 200:
@@ -327,15 +531,33 @@ def ping():
 
 @app.route('/share-file', methods=['POST'])
 def share_file():
-    logger.debug("=== Starting file share request ===")
+    # Each request works in its own workspace, so shares can run in parallel
+    workspace = tools.Workspace()
+    try:
+        return handle_share(workspace)
+    finally:
+        if not workspace.detached:
+            workspace.cleanup()
+
+def handle_share(workspace):
+    logger.debug(f"=== Starting file share request (job {workspace.job_id}) ===")
+    upload_folder = workspace.path('uploads')
     
     try:
+        # The form is read as it streams in, so the file can be encrypted while
+        # it arrives instead of after the whole upload has been spooled
+        try:
+            form = upload.MultipartStream(request.stream, request.content_type)
+            file = form.next_file()
+        except ValueError as e:
+            logger.error(f"Bad upload: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Bad upload: {str(e)}'}), 400
+
         # Check if request has file part
-        if 'file' not in request.files:
+        if file is None or file.name != 'file':
             logger.error("No file part in request")
             return jsonify({'status': 'error', 'message': 'No file part in request'}), 400
             
-        file = request.files['file']
         if file.filename == '':
             logger.error("No file selected")
             return jsonify({'status': 'error', 'message': 'No file selected'}), 400
@@ -358,99 +580,91 @@ def share_file():
             return jsonify({'status': 'error', 'message': 'Invalid filename'}), 400
             
         # Create file path
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file_path = os.path.join(upload_folder, filename)
         logger.debug(f"Saving file to: {file_path}")
         
         # Ensure upload directory exists and is writable
         try:
-            if not os.path.exists(app.config['UPLOAD_FOLDER']):
-                os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-                logger.debug(f"Created upload directory: {app.config['UPLOAD_FOLDER']}")
+            if not os.path.exists(upload_folder):
+                os.makedirs(upload_folder, exist_ok=True)
+                logger.debug(f"Created upload directory: {upload_folder}")
             
             # Check if directory is writable
-            if not os.access(app.config['UPLOAD_FOLDER'], os.W_OK):
-                raise Exception(f"Upload directory is not writable: {app.config['UPLOAD_FOLDER']}")
+            if not os.access(upload_folder, os.W_OK):
+                raise Exception(f"Upload directory is not writable: {upload_folder}")
                 
         except Exception as e:
             logger.error(f"Upload directory issue: {str(e)}")
             return jsonify({'status': 'error', 'message': f'Upload directory error: {str(e)}'}), 500
         
-        # Save the file
+        # The peer is read once, here, before the file streams in: it decides
+        # the delta chapters to leave out and whether the JSON size limit
+        # applies, so it has to come before the file in the form (as the
+        # connect page sends it)
+        peer_ip = form.form.get('peer')
+
+        # The JSON answer carries the whole container, so only files that fit
+        # in a normal request body may take that way; binary shares and
+        # pushes to a peer stream the pieces
+        json_answer = not peer_ip and not wants_binary()
+        if json_answer and (request.content_length or 0) > app.config['MAX_CONTENT_LENGTH']:
+            return too_large_for_json()
+
+        # Encrypt the file as it arrives; the plaintext is kept beside it for
+        # pushes to peers. A peer named before the file gets only the
+        # content-defined chapters it doesn't have yet
+        sent = delta.load_index(peer_ip, filename, app.config['SENT_INDEX']) \
+            if peer_ip and app.config['CHUNKING'] == 'cdc' else {}
         try:
-            logger.debug(f"Attempting to save file to: {file_path}")
-            file.save(file_path)
-            logger.debug(f"File.save() completed for: {file_path}")
-            
-            # Verify file was saved correctly
-            if not os.path.exists(file_path):
-                raise Exception("File was not saved properly - file does not exist after save")
-            
+            logger.debug(f"Streaming upload to: {file_path}")
+            with open(file_path, 'wb') as sink:
+                file.sink = sink
+                key_path = encrypt_file(file_path, workspace, known=sent or None,
+                                        source=file, size_hint=request.content_length)
+                form.finish()
+
             file_size = os.path.getsize(file_path)
             if file_size == 0:
                 raise Exception("Saved file is empty")
             
-            logger.debug(f"File saved and verified successfully - size: {file_size} bytes")
+            logger.debug(f"File received and encrypted - size: {file_size} bytes")
+            if json_answer and file_size > app.config['MAX_CONTENT_LENGTH']:
+                # A chunked upload has no Content-Length to check up front
+                return too_large_for_json()
                 
         except Exception as e:
+            if not file.done:
+                # The client went away or sent a broken body
+                logger.error(f"Upload did not complete: {str(e)}")
+                return jsonify({'status': 'error', 'message': f'Upload did not complete: {str(e)}'}), 400
             logger.error(f"Error saving file: {str(e)}")
-            logger.error(f"Upload folder: {app.config['UPLOAD_FOLDER']}")
+            logger.error(f"Upload folder: {upload_folder}")
             logger.error(f"File path: {file_path}")
-            logger.error(f"Upload folder exists: {os.path.exists(app.config['UPLOAD_FOLDER'])}")
-            logger.error(f"Upload folder writable: {os.access(app.config['UPLOAD_FOLDER'], os.W_OK) if os.path.exists(app.config['UPLOAD_FOLDER']) else 'N/A'}")
+            logger.error(f"Upload folder exists: {os.path.exists(upload_folder)}")
+            logger.error(f"Upload folder writable: {os.access(upload_folder, os.W_OK) if os.path.exists(upload_folder) else 'N/A'}")
             return jsonify({'status': 'error', 'message': f'Failed to save file: {str(e)}'}), 500
         
-        # Encrypt the file
-        try:
-            logger.debug("Starting encryption process")
-            key_path = encrypt_file(file_path)
-            logger.debug(f"File encrypted successfully, key path: {key_path}")
-            
-            # Read the key with error handling
-            try:
-                with open(key_path, 'rb') as f:
-                    key_data = f.read()
-                if not key_data:
-                    raise Exception("Key file is empty")
-                key_b64 = base64.b64encode(key_data).decode('utf-8')
-                logger.debug("Key converted to base64 successfully")
-            except Exception as e:
-                logger.error(f"Error reading key file: {str(e)}")
-                raise Exception(f"Failed to read encryption key: {str(e)}")
-            
-            # Read the encrypted file
+        # Push straight to a peer when the form names one
+        if peer_ip:
+            if wants_background():
+                return start_job('send', workspace, send_result, file_path, filename, peer_ip, key_path, sent)
             try:
-                encrypted_files = tools.list_dir('encrypted')
-                if not encrypted_files:
-                    raise Exception("No encrypted file found")
-                
-                encrypted_file_path = os.path.join('encrypted', encrypted_files[0])
-                logger.debug(f"Reading encrypted file: {encrypted_file_path}")
-                
-                with open(encrypted_file_path, 'rb') as f:
-                    encrypted_data = f.read()
-                if not encrypted_data:
-                    raise Exception("Encrypted file is empty")
-                    
-                encrypted_b64 = base64.b64encode(encrypted_data).decode('utf-8')
-                logger.debug("Encrypted file converted to base64 successfully")
+                return jsonify(send_result(workspace, file_path, filename, peer_ip, key_path, sent))
             except Exception as e:
-                logger.error(f"Error reading encrypted file: {str(e)}")
-                raise Exception(f"Failed to read encrypted file: {str(e)}")
-            
-            logger.debug("=== File share request completed successfully ===")
-            return jsonify({
-                'status': 'success',
-                'message': 'File encrypted and ready to share',
-                'key': key_b64,
-                'encrypted_file': encrypted_b64,
-                'filename': filename,
-                'file_size': len(encrypted_data)
-            })
-            
+                logger.error(f"Error sending file to {peer_ip}: {str(e)}")
+                return jsonify({'status': 'error', 'message': f'Send failed: {str(e)}'}), 502
+
+        # Binary shares stream the encrypted file back
+        if wants_binary():
+            return stream_share(workspace, key_path, filename)
+
+        # Package the encrypted file, in the background when asked to
+        if wants_background():
+            return start_job('share', workspace, share_job_result, file_path, filename, key_path, hold=True)
+        try:
+            return jsonify(share_result(workspace, file_path, filename, key_path))
         except Exception as e:
             logger.error(f"Error during encryption process: {str(e)}")
-            # Clean up the uploaded file if encryption fails
-            safe_remove_file(file_path)
             return jsonify({'status': 'error', 'message': f'Encryption failed: {str(e)}'}), 500
             
     except Exception as e:
@@ -458,9 +672,266 @@ def share_file():
         logger.error(f"Traceback: {traceback.format_exc()}")
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
+def too_large_for_json():
+    limit = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    logger.error(f"Upload over {limit} MB for a JSON share")
+    return jsonify({'status': 'error', 'message': f'Files over {limit} MB are not returned as JSON; '
+                    f'share them with ?format=binary or push them to a peer'}), 413
+
+def share_result(workspace, file_path, filename, key_path=None, progress=None, inline=True):
+    """Encrypt an uploaded file and return the response data for the peer
+
+    key_path is given when the upload was already encrypted as it arrived.
+    Without inline the container is left out of the result and stays in
+    the workspace.
+    """
+    if key_path is None:
+        logger.debug("Starting encryption process")
+        key_path = encrypt_upload(file_path, workspace, progress)
+        logger.debug(f"File encrypted successfully, key path: {key_path}")
+    elif progress:
+        report_encrypted(workspace, progress)
+
+    # Read the key with error handling
+    try:
+        with open(key_path, 'rb') as f:
+            key_data = f.read()
+        if not key_data:
+            raise Exception("Key file is empty")
+        key_b64 = base64.b64encode(key_data).decode('utf-8')
+        logger.debug("Key converted to base64 successfully")
+    except Exception as e:
+        logger.error(f"Error reading key file: {str(e)}")
+        raise Exception(f"Failed to read encryption key: {str(e)}")
+
+    # Read the packed container and the sealed key information
+    try:
+        encrypted_file_path = workspace.path('encrypted', container.PACK_NAME)
+        if not os.path.exists(encrypted_file_path):
+            raise Exception("No encrypted file found")
+
+        file_size = os.path.getsize(encrypted_file_path)
+        if not file_size:
+            raise Exception("Encrypted file is empty")
+
+        if inline:
+            logger.debug(f"Reading encrypted file: {encrypted_file_path}")
+            with open(encrypted_file_path, 'rb') as f:
+                encrypted_b64 = base64.b64encode(f.read()).decode('utf-8')
+            logger.debug("Encrypted file converted to base64 successfully")
+
+        with open(workspace.path('raw_data', 'store_in_me.enc'), 'rb') as f:
+            key_store_b64 = base64.b64encode(f.read()).decode('utf-8')
+    except Exception as e:
+        logger.error(f"Error reading encrypted file: {str(e)}")
+        raise Exception(f"Failed to read encrypted file: {str(e)}")
+
+    logger.debug("=== File share request completed successfully ===")
+    result = {
+        'status': 'success',
+        'message': 'File encrypted and ready to share',
+        'key': key_b64,
+        'key_store': key_store_b64,
+        'filename': filename,
+        'file_size': file_size
+    }
+    if inline:
+        result['encrypted_file'] = encrypted_b64
+    return result
+
+def share_job_result(workspace, *args, progress=None):
+    """Job body of a background share: the container is fetched from /jobs/<job_id>/encrypted-file"""
+    return share_result(workspace, *args, progress=progress, inline=False)
+
+def report_encrypted(workspace, progress):
+    """Count the pieces encrypted while the upload arrived towards a job's progress"""
+    pieces = container.open_pieces(workspace.path('encrypted'))
+    try:
+        for index in range(len(pieces)):
+            progress(index, pieces.length(index), len(pieces))
+    finally:
+        pieces.close()
+
+def share_fields(workspace, key_path, filename):
+    """Return the transfer fields of an encrypted workspace"""
+    fields = {'filename': filename}
+    with open(key_path, 'rb') as f:
+        fields['key'] = f.read()
+    with open(workspace.path('raw_data', 'store_in_me.enc'), 'rb') as f:
+        fields['key_store'] = f.read()
+    return fields
+
+def stream_share(workspace, key_path, filename):
+    """Answer with the binary transfer stream of an encrypted workspace"""
+    fields = share_fields(workspace, key_path, filename)
+    pieces = container.open_pieces(workspace.path('encrypted'))
+
+    def cleanup():
+        pieces.close()
+        workspace.cleanup()
+
+    # The pieces are read while the response is sent, so the workspace has to
+    # outlive this request
+    workspace.detached = True
+    response = Response(transfer.iter_frames(fields, pieces), mimetype=transfer.CONTENT_TYPE)
+    response.call_on_close(cleanup)
+    logger.debug(f"Streaming {len(pieces)} pieces of {filename}")
+    return response
+
+def send_result(workspace, file_path, filename, peer_ip, key_path=None, sent=None, progress=None):
+    """Encrypt an uploaded file, push it to a peer and return the peer's answer
+
+    key_path is given when the upload was already encrypted as it arrived,
+    without the content-defined chapters in sent.
+    """
+    encrypting = key_path is None
+
+    def both(index, nbytes, total=None):
+        # When the job encrypts too, encrypting and sending each count every
+        # piece towards the job total; otherwise only sending does
+        if progress:
+            progress(index, nbytes, total * 2 if total and encrypting else total)
+
+    # Content-defined chapters this peer got with the last copy of the file
+    # are neither encrypted nor sent again
+    cdc = app.config['CHUNKING'] == 'cdc' and not isinstance(file_path, list)
+    if key_path is None:
+        sent = delta.load_index(peer_ip, filename, app.config['SENT_INDEX']) if cdc else {}
+        key_path = encrypt_upload(file_path, workspace, both, known=sent or None)
+    sent = sent or {}
+    pieces = container.open_pieces(workspace.path('encrypted'))
+    try:
+        logger.debug(f"Sending {len(pieces)} pieces of {filename} to {peer_ip}")
+        digests = None
+        if cdc:
+            # Pieces the peer already holds are only announced by their digest
+            ctx, archive, meta = dec.open_archive(workspace.root)
+            try:
+                recipe = dec.read_recipe(ctx, archive, meta)
+            finally:
+                archive.close()
+            if 'pieces' in meta:
+                # The piece table has the digest of every piece, skipped or not
+                digests = [digest for _, digest in meta['pieces'][:len(recipe)]]
+            else:
+                digests = []
+                for index, (_, _, key) in enumerate(recipe):
+                    data = pieces.read(index)
+                    digests.append(hashlib.sha256(data).digest() if data else sent[key])
+            logger.debug(f"Delta re-share: {len(recipe) - sum(1 for _, _, key in recipe if key in sent)} "
+                         f"of {len(recipe)} chapters are new for {peer_ip}")
+            pieces = delta.DeltaPieces(pieces, recipe, file_path)
+        result = peer_client.send(peer_ip, share_fields(workspace, key_path, filename), pieces, digests=digests,
+                                  workers=app.config['SEND_WORKERS'], progress=both,
+                                  retries=app.config['SEND_RETRIES'])
+        if cdc:
+            delta.save_index(peer_ip, filename, [(key, digest) for (_, _, key), digest in zip(recipe, digests)],
+                             app.config['SENT_INDEX'])
+    finally:
+        pieces.close()
+
+    logger.debug(f"=== File sent to {peer_ip} successfully ===")
+    answer = {
+        'status': 'success',
+        'message': f'File sent to {peer_ip}',
+        'peer': peer_ip,
+        'filename': result.get('filename', filename)
+    }
+    if 'filenames' in result:
+        # A batch: the names the peer stored every file under
+        answer['filenames'] = result['filenames']
+    return answer
+
+@app.route('/share-batch', methods=['POST'])
+def share_batch():
+    # Many files, or a folder, shared with one key, one container and one manifest
+    workspace = tools.Workspace()
+    try:
+        return handle_share_batch(workspace)
+    finally:
+        if not workspace.detached:
+            workspace.cleanup()
+
+def handle_share_batch(workspace):
+    logger.debug(f"=== Starting batch share request (job {workspace.job_id}) ===")
+    # Every file is written straight to the workspace as it streams in
+    try:
+        form = upload.MultipartStream(request.stream, request.content_type)
+    except ValueError as e:
+        logger.error(f"Bad upload: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Bad upload: {str(e)}'}), 400
+
+    # Folder uploads name files by their relative path; secure_filename
+    # flattens that, so clashing names are numbered
+    file_paths = []
+    names = set()
+    while True:
+        try:
+            file = form.next_file()
+        except ValueError as e:
+            logger.error(f"Bad upload: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Bad upload: {str(e)}'}), 400
+        if file is None:
+            break
+        if file.name != 'files' or not file.filename:
+            continue
+        if not allowed_file(file.filename):
+            logger.error(f"Invalid file format: {file.filename}")
+            return jsonify({'status': 'error', 'message': f'Invalid file format: {file.filename}. Allowed: {ALLOWED_EXTENSIONS}'}), 400
+        filename = secure_filename(file.filename)
+        if not filename:
+            logger.error(f"Invalid filename: {file.filename}")
+            return jsonify({'status': 'error', 'message': f'Invalid filename: {file.filename}'}), 400
+        base, ext = os.path.splitext(filename)
+        counter = 1
+        while filename in names:
+            filename = f"{base}_{counter}{ext}"
+            counter += 1
+        names.add(filename)
+        file_path = workspace.path('uploads', filename)
+        try:
+            file.save(file_path)
+        except ValueError as e:
+            logger.error(f"Upload of {filename} did not complete: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Upload did not complete: {str(e)}'}), 400
+        except Exception as e:
+            logger.error(f"Error saving file {filename}: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Failed to save file: {str(e)}'}), 500
+        file_paths.append(file_path)
+    if not file_paths:
+        logger.error("No files in batch request")
+        return jsonify({'status': 'error', 'message': 'No files selected'}), 400
+    batch_name = secure_filename(form.form.get('name', '')) or f'batch_{len(file_paths)}_files'
+    logger.debug(f"Batch {batch_name}: {len(file_paths)} files saved")
+
+    # Same ways out as a single file share
+    peer_ip = form.form.get('peer')
+    try:
+        if peer_ip:
+            if wants_background():
+                return start_job('send', workspace, send_result, file_paths, batch_name, peer_ip)
+            return jsonify(send_result(workspace, file_paths, batch_name, peer_ip))
+        if wants_binary():
+            return stream_share(workspace, encrypt_batch(file_paths, workspace), batch_name)
+        if wants_background():
+            return start_job('share', workspace, share_job_result, file_paths, batch_name, hold=True)
+        return jsonify(share_result(workspace, file_paths, batch_name))
+    except Exception as e:
+        logger.error(f"Error during batch share: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Batch share failed: {str(e)}'}), 500
+
 @app.route('/receive-file', methods=['POST'])
 def receive_file():
-    logger.debug("=== Starting file receive request ===")
+    # Each request works in its own workspace, so receives can run in parallel
+    workspace = tools.Workspace()
+    try:
+        return handle_receive(workspace)
+    finally:
+        if not workspace.detached:
+            workspace.cleanup()
+
+def handle_receive(workspace):
+    logger.debug(f"=== Starting file receive request (job {workspace.job_id}) ===")
     
     try:
         # Check if request is JSON
@@ -474,7 +945,7 @@ def receive_file():
             return jsonify({'status': 'error', 'message': 'No JSON data'}), 400
             
         # Check required fields
-        required_fields = ['encrypted_file', 'key', 'filename']
+        required_fields = ['encrypted_file', 'key', 'key_store', 'filename']
         for field in required_fields:
             if field not in data:
                 logger.error(f"Missing required field: {field}")
@@ -492,17 +963,12 @@ def receive_file():
         logger.debug(f"Receiving file: {filename}")
         
         # Define paths with unique names
-        encrypted_file_raw_data_path = os.path.join('raw_data', 'store_in_me.enc')
-        key_path = os.path.join(app.config['UPLOAD_KEY'], f'{filename}.key')
+        encrypted_file_raw_data_path = workspace.path('encrypted', container.PACK_NAME)
+        key_store_path = workspace.path('raw_data', 'store_in_me.enc')
+        key_path = workspace.path('key', f'{filename}.key')
         
         try:
-            # Clean up any existing files with similar names
-            potential_conflict = os.path.join('raw_data', 'store_in_me.enc')
-            safe_remove_file(potential_conflict)
-            potential_conflict = os.path.join(app.config['UPLOAD_FOLDER'], 'store_in_me.enc')
-            safe_remove_file(potential_conflict)
-            
-            # Decode and save the encrypted file
+            # Decode and save the encrypted container with its key information
             try:
                 if not encrypted_b64:
                     raise Exception("No encrypted file data provided")
@@ -511,11 +977,14 @@ def receive_file():
                 if not encrypted_data:
                     raise Exception("Decoded encrypted data is empty")
                     
-                # Ensure raw_data directory exists
-                os.makedirs('raw_data', exist_ok=True)
-                    
                 with open(encrypted_file_raw_data_path, 'wb') as f:
                     f.write(encrypted_data)
+                with open(key_store_path, 'wb') as f:
+                    f.write(base64.b64decode(data['key_store']))
+                if data.get('meta_data'):
+                    # Senders from before the key blob keep the metadata apart
+                    with open(workspace.path('raw_data', 'meta_data.txt'), 'w') as f:
+                        f.write(data['meta_data'])
                 logger.debug(f"Encrypted file saved to: {encrypted_file_raw_data_path} ({len(encrypted_data)} bytes)")
             except Exception as e:
                 logger.error(f"Error saving encrypted file: {str(e)}")
@@ -530,62 +999,19 @@ def receive_file():
                 if not key_data:
                     raise Exception("Decoded key data is empty")
                 
-                # Ensure key directory exists
-                os.makedirs(app.config['UPLOAD_KEY'], exist_ok=True)
-                    
                 with open(key_path, 'wb') as f:
                     f.write(key_data)
                 logger.debug(f"Key saved to: {key_path} ({len(key_data)} bytes)")
+                check_archive(workspace)
             except Exception as e:
                 logger.error(f"Error saving key: {str(e)}")
                 safe_remove_file(encrypted_file_raw_data_path)
                 return jsonify({'status': 'error', 'message': f'Failed to process key: {str(e)}'}), 400
             
-            # Decrypt the file
-            try:
-                logger.debug("Starting decryption process")
-                decrypted_path = decrypt_file(encrypted_file_raw_data_path, key_path)
-                logger.debug(f"File decrypted to: {decrypted_path}")
-            except Exception as e:
-                logger.error(f"Decryption failed: {str(e)}")
-                safe_remove_file(encrypted_file_raw_data_path)
-                safe_remove_file(key_path)
-                return jsonify({'status': 'error', 'message': f'File decryption failed: {str(e)}'}), 500
-            
-            # Move the decrypted file to received_files directory
-            try:
-                # Ensure received_files directory exists
-                os.makedirs('received_files', exist_ok=True)
-                
-                # Use the original filename for the final file
-                received_path = os.path.join('received_files', original_filename)
-                
-                # If file exists, create a unique name
-                counter = 1
-                while os.path.exists(received_path):
-                    base_name, ext = os.path.splitext(original_filename)
-                    received_path = os.path.join('received_files', f"{base_name}_{counter}{ext}")
-                    counter += 1
-                
-                shutil.move(decrypted_path, received_path)
-                final_filename = os.path.basename(received_path)
-                logger.debug(f"Decrypted file moved to: {received_path}")
-            except Exception as e:
-                logger.error(f"Error moving decrypted file: {str(e)}")
-                safe_remove_file(encrypted_file_raw_data_path)
-                safe_remove_file(key_path)
-                return jsonify({'status': 'error', 'message': f'Failed to save final file: {str(e)}'}), 500
-            
-            # Clean up temporary files
-            safe_remove_file(encrypted_file_raw_data_path)
-            safe_remove_file(key_path)
-            
-            logger.debug("=== File receive request completed successfully ===")
-            return jsonify({
-                'status': 'success',
-                'message': 'File received and decrypted successfully',
-                'filename': final_filename
-            })
+            # Keep or decrypt the file, in the background when asked to
+            if wants_background():
+                return start_job('receive', workspace, finish_receive, filename)
+            return jsonify(finish_receive(workspace, filename))
             
         except Exception as e:
             logger.error(f"Error during file processing: {str(e)}")
@@ -599,13 +1025,378 @@ def receive_file():
         logger.error(f"Traceback: {traceback.format_exc()}")
         return jsonify({'status': 'error', 'message': f'Server error: {str(e)}'}), 500
 
+@app.route('/receive-stream', methods=['POST'])
+def receive_stream():
+    # Same as /receive-file, but the body is a binary transfer stream
+    workspace = tools.Workspace()
+    try:
+        return handle_receive_stream(workspace)
+    finally:
+        if not workspace.detached:
+            workspace.cleanup()
+
+def handle_receive_stream(workspace):
+    logger.debug(f"=== Starting stream receive request (job {workspace.job_id}) ===")
+
+    # Read the fields, then write each piece to the container as it arrives
+    try:
+        stream = request.stream
+        fields = transfer.read_fields(stream)
+        filename = secure_filename(fields['filename'].decode('utf-8'))
+        if not filename:
+            logger.error("Invalid filename after securing")
+            return jsonify({'status': 'error', 'message': 'Invalid filename'}), 400
+        if not fields['key']:
+            logger.error("No key data provided")
+            return jsonify({'status': 'error', 'message': 'No key data provided'}), 400
+
+        logger.debug(f"Receiving file: {filename}")
+        with open(workspace.path('key', f'{filename}.key'), 'wb') as f:
+            f.write(fields['key'])
+        with open(workspace.path('raw_data', 'store_in_me.enc'), 'wb') as f:
+            f.write(fields['key_store'])
+        check_archive(workspace)
+        with container.ContainerWriter(workspace.path('encrypted', container.PACK_NAME)) as writer:
+            for piece in transfer.iter_pieces(stream):
+                writer.add(piece)
+        if not len(writer):
+            raise ValueError("Transfer stream has no pieces")
+        logger.debug(f"Received {len(writer)} pieces")
+    except ValueError as e:
+        logger.error(f"Bad transfer stream: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Bad transfer stream: {str(e)}'}), 400
+
+    # Keep or decrypt the file, in the background when asked to
+    if wants_background():
+        return start_job('receive', workspace, finish_receive, filename)
+    try:
+        return jsonify(finish_receive(workspace, filename))
+    except Exception as e:
+        logger.error(f"Error during file processing: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Processing failed: {str(e)}'}), 500
+
+TRANSFER_FILE = 'transfer.txt'
+
+def register_transfer(workspace, filename, count, table=None):
+    """Track an incoming transfer; its bitmap starts from the pieces already on disk
+
+    table is the piece table from the transfer's key blob, which every
+    piece is checked against as it arrives.
+    """
+    bitmap = transfer.PieceBitmap(count)
+    for name in tools.list_dir(workspace.path('encrypted')):
+        digits = name[len('SECRET'):]
+        if name.startswith('SECRET') and digits.isdigit() and int(digits) < count:
+            bitmap.add(int(digits))
+    # The workspace lives on between the requests of the transfer
+    workspace.detached = True
+    with incoming_lock:
+        incoming_transfers[workspace.job_id] = {'workspace': workspace, 'filename': filename,
+                                                'pieces': count, 'bitmap': bitmap, 'table': table,
+                                                'touched': time.time()}
+
+def load_transfers():
+    """Pick up the unfinished transfers of an earlier run so peers can resume them"""
+    for job_id in tools.list_dir(tools.WORKSPACES):
+        path = os.path.join(tools.WORKSPACES, job_id, TRANSFER_FILE)
+        if not os.path.isfile(path):
+            continue
+        try:
+            info = tools.read_meta_data(path)
+            workspace = tools.Workspace(job_id)
+            register_transfer(workspace, info['File_Name'], int(info['pieces']),
+                              dec.read_meta(workspace.root).get('pieces'))
+            logger.debug(f"Resumable transfer {job_id}: {info['File_Name']}")
+        except Exception as e:
+            logger.error(f"Error loading transfer {job_id}: {str(e)}")
+
+def forget_stale_transfers():
+    """Drop transfers no peer has touched for TRANSFER_KEEP_SECONDS"""
+    now = time.time()
+    with incoming_lock:
+        stale = [transfer_id for transfer_id, entry in incoming_transfers.items()
+                 if now - entry['touched'] > app.config['TRANSFER_KEEP_SECONDS']]
+        entries = [incoming_transfers.pop(transfer_id) for transfer_id in stale]
+    for entry in entries:
+        logger.debug(f"Dropping stale transfer {entry['workspace'].job_id}")
+        entry['workspace'].cleanup()
+
+@app.route('/transfers', methods=['POST'])
+def begin_transfer():
+    # A peer pushes a file piece by piece: begin, one PUT per piece, finish.
+    # Until finish, GET /transfers/<id> tells the peer which pieces to resend.
+    forget_stale_transfers()
+    workspace = tools.Workspace()
+    try:
+        fields = transfer.read_fields(request.stream)
+        filename = secure_filename(fields['filename'].decode('utf-8'))
+        count = request.args.get('pieces', type=int)
+        if not filename or not fields['key'] or not count or count < 1:
+            raise ValueError("Missing file name, key or piece count")
+
+        with open(workspace.path('key', f'{filename}.key'), 'wb') as f:
+            f.write(fields['key'])
+        with open(workspace.path('raw_data', 'store_in_me.enc'), 'wb') as f:
+            f.write(fields['key_store'])
+        # The piece table lets every piece be checked as it comes in
+        table = check_archive(workspace).get('pieces')
+        if table is not None and len(table) != count:
+            raise ValueError(f"Piece count {count} does not match the piece table")
+        # Written last, so a transfer is only picked up after a restart once
+        # everything it needs is on disk
+        with open(workspace.path(TRANSFER_FILE), 'w') as f:
+            f.write(f"File_Name={filename}\npieces={count}\n")
+    except ValueError as e:
+        workspace.cleanup()
+        logger.error(f"Bad transfer request: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Bad transfer request: {str(e)}'}), 400
+
+    register_transfer(workspace, filename, count, table)
+    logger.debug(f"Transfer {workspace.job_id} started: {filename}, {count} pieces")
+    return jsonify({'status': 'success', 'transfer_id': workspace.job_id})
+
+def get_transfer(transfer_id):
+    with incoming_lock:
+        entry = incoming_transfers.get(transfer_id)
+        if entry is not None:
+            entry['touched'] = time.time()
+        return entry
+
+@app.route('/transfers/<transfer_id>')
+def transfer_status(transfer_id):
+    entry = get_transfer(transfer_id)
+    if entry is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found'}), 404
+    with incoming_lock:
+        bitmap = entry['bitmap'].to_bytes()
+        received = len(entry['bitmap'])
+    return jsonify({
+        'status': 'success',
+        'transfer_id': transfer_id,
+        'pieces': entry['pieces'],
+        'received': received,
+        'bitmap': base64.b64encode(bitmap).decode('ascii')
+    })
+
+@app.route('/transfers/<transfer_id>/have', methods=['POST'])
+def offer_digests(transfer_id):
+    # The sender lists the SHA-256 of its pieces; the ones in our piece store
+    # are linked in and marked as received without being sent
+    entry = get_transfer(transfer_id)
+    if entry is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found'}), 404
+    data = request.get_data()
+    if len(data) % 32 or len(data) // 32 > entry['pieces']:
+        return jsonify({'status': 'error', 'message': 'Bad digest list'}), 400
+
+    found = 0
+    for index in range(len(data) // 32):
+        digest = data[index * 32:(index + 1) * 32]
+        if entry['table'] is not None and entry['table'][index][1] != digest:
+            # Only the digests sealed with the keys are trusted
+            continue
+        path = entry['workspace'].path('encrypted', 'SECRET%07d' % index)
+        if pieces_held.link(digest, path):
+            with incoming_lock:
+                entry['bitmap'].add(index)
+            found += 1
+    logger.debug(f"Transfer {transfer_id}: {found} of {len(data) // 32} pieces already held")
+    return transfer_status(transfer_id)
+
+@app.route('/transfers/<transfer_id>/pieces/<int:index>', methods=['PUT'])
+def put_piece(transfer_id, index):
+    entry = get_transfer(transfer_id)
+    if entry is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found'}), 404
+    if index >= entry['pieces']:
+        return jsonify({'status': 'error', 'message': 'Piece index out of range'}), 400
+    data = request.get_data()
+    if not data:
+        return jsonify({'status': 'error', 'message': 'Empty piece'}), 400
+    if entry['table'] is not None and container.piece_entry(data) != tuple(entry['table'][index]):
+        # Left unmarked, so the sender's next round sends it again
+        logger.error(f"Transfer {transfer_id}: piece {index} does not match the piece table")
+        return jsonify({'status': 'error', 'message': f'Piece {index} does not match its digest'}), 400
+
+    # Pieces arrive in any order, so they go into the one-file-per-piece
+    # layout; only complete pieces are renamed into place and marked. A
+    # retried PUT can overlap the original, so each gets its own temp file
+    path = entry['workspace'].path('encrypted', 'SECRET%07d' % index)
+    temp = f'{path}.{uuid.uuid4().hex}.part'
+    try:
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+    except BaseException:
+        safe_remove_file(temp)
+        raise
+    with incoming_lock:
+        entry['bitmap'].add(index)
+    return jsonify({'status': 'success', 'index': index})
+
+@app.route('/transfers/<transfer_id>/finish', methods=['POST'])
+def finish_transfer(transfer_id):
+    entry = get_transfer(transfer_id)
+    if entry is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found'}), 404
+    workspace = entry['workspace']
+
+    # This request owns the workspace from here on
+    with incoming_lock:
+        received = len(entry['bitmap'])
+        if received != entry['pieces']:
+            return jsonify({'status': 'error', 'message': f"Only {received} of {entry['pieces']} pieces received"}), 409
+        if incoming_transfers.pop(transfer_id, None) is None:
+            return jsonify({'status': 'error', 'message': 'Transfer already finished'}), 409
+    workspace.detached = False
+    try:
+        safe_remove_file(workspace.path(TRANSFER_FILE))
+        meta = dec.read_meta(workspace.root)
+        if meta.get('chunking') == 'cdc':
+            # Keep the pieces as links into the store instead of packing
+            # copies; the last one is the recipe, unique to this file
+            pieces = container.open_pieces(workspace.path('encrypted'))
+            for name in pieces.names[:-1]:
+                pieces_held.absorb(workspace.path('encrypted', name))
+        else:
+            container.pack_directory(workspace.path('encrypted'))
+        if wants_background():
+            return start_job('receive', workspace, finish_receive, entry['filename'])
+        try:
+            return jsonify(finish_receive(workspace, entry['filename']))
+        except Exception as e:
+            logger.error(f"Error during file processing: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Processing failed: {str(e)}'}), 500
+    finally:
+        if not workspace.detached:
+            workspace.cleanup()
+
+@app.route('/transfers/<transfer_id>', methods=['DELETE'])
+def abort_transfer(transfer_id):
+    with incoming_lock:
+        entry = incoming_transfers.pop(transfer_id, None)
+    if entry is None:
+        return jsonify({'status': 'error', 'message': 'Transfer not found'}), 404
+    entry['workspace'].cleanup()
+    logger.debug(f"Transfer {transfer_id} aborted")
+    return jsonify({'status': 'success'})
+
+def finish_receive(workspace, filename, progress=None):
+    """Store or decrypt a received archive and return the response data"""
+    meta = dec.read_meta(workspace.root)
+    if 'batch' in meta:
+        return finish_receive_batch(workspace, progress)
+
+    if app.config['KEEP_CIPHERTEXT']:
+        # Keep only the ciphertext; /download decrypts it on the fly. Nothing
+        # is decrypted now, so check the pieces arrived whole first
+        try:
+            dec.verify(workspace.root, workers=app.config['CRYPTO_WORKERS'])
+        except ValueError as e:
+            logger.error(f"Received archive is damaged: {str(e)}")
+            raise Exception(f"Verification failed: {str(e)}")
+        try:
+            final_filename = keep_ciphertext(filename, workspace)
+        except Exception as e:
+            logger.error(f"Error keeping encrypted file: {str(e)}")
+            raise Exception(f"Failed to save final file: {str(e)}")
+
+        logger.debug("=== File receive request completed successfully ===")
+        return {
+            'status': 'success',
+            'message': 'File received and stored encrypted',
+            'filename': final_filename
+        }
+
+    # Decrypt the file
+    try:
+        logger.debug("Starting decryption process")
+        decrypted_path = decrypt_file(workspace.path('encrypted'),
+                                      workspace.path('key', f'{filename}.key'), workspace, progress)
+        logger.debug(f"File decrypted to: {decrypted_path}")
+    except Exception as e:
+        logger.error(f"Decryption failed: {str(e)}")
+        raise Exception(f"File decryption failed: {str(e)}")
+    
+    # Move the decrypted file to received_files directory
+    try:
+        # Ensure received_files directory exists
+        os.makedirs('received_files', exist_ok=True)
+        
+        # Use the secured filename, numbered if it is already taken
+        final_filename = move_received(decrypted_path, filename)
+        logger.debug(f"Decrypted file moved to: {os.path.join('received_files', final_filename)}")
+    except Exception as e:
+        logger.error(f"Error moving decrypted file: {str(e)}")
+        raise Exception(f"Failed to save final file: {str(e)}")
+    
+    logger.debug("=== File receive request completed successfully ===")
+    return {
+        'status': 'success',
+        'message': 'File received and decrypted successfully',
+        'filename': final_filename
+    }
+
+def finish_receive_batch(workspace, progress=None):
+    """Decrypt every file of a received batch into received_files"""
+    # Batches are always decrypted; each file is downloaded on its own
+    try:
+        outputs = dec.decrypt_batch(workspace.path('restored_file'), workers=app.config['CRYPTO_WORKERS'],
+                                    root=workspace.root, progress=progress)
+    except Exception as e:
+        logger.error(f"Batch decryption failed: {str(e)}")
+        raise Exception(f"File decryption failed: {str(e)}")
+
+    os.makedirs('received_files', exist_ok=True)
+    filenames = []
+    for output in outputs:
+        filenames.append(move_received(output, secure_filename(os.path.basename(output)) or 'file'))
+
+    logger.debug(f"=== Batch of {len(filenames)} files received successfully ===")
+    return {
+        'status': 'success',
+        'message': f'{len(filenames)} files received and decrypted successfully',
+        'filenames': filenames
+    }
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    info = job.snapshot()
+    if 'result' in info and job.held is not None:
+        info['result'] = dict(info['result'], encrypted_file_url=url_for('job_encrypted_file', job_id=job_id))
+    return jsonify(info)
+
+@app.route('/jobs/<job_id>/encrypted-file')
+def job_encrypted_file(job_id):
+    """Stream the container of a finished background share"""
+    job = job_queue.get(job_id)
+    workspace = job.held if job is not None else None
+    if workspace is None or job.status != 'done':
+        return jsonify({'status': 'error', 'message': 'No encrypted file for this job'}), 404
+    path = workspace.path('encrypted', container.PACK_NAME)
+    if not os.path.exists(path):
+        return jsonify({'status': 'error', 'message': 'No encrypted file for this job'}), 404
+    return send_file(path, mimetype='application/octet-stream')
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Job not found'}), 404
+    job.cancel()
+    return jsonify(job.snapshot())
+
 @app.route('/received-files')
 def get_received_files():
     try:
         files = []
-        if os.path.exists('received_files'):
-            files = os.listdir('received_files')
-        return jsonify({'files': files})
+        for directory in ('received_files', RECEIVED_ENCRYPTED):
+            if os.path.exists(directory):
+                files.extend(os.listdir(directory))
+        return jsonify({'files': sorted(files)})
     except Exception as e:
         logger.error(f"Error in get_received_files: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -613,7 +1404,10 @@ def get_received_files():
 @app.route('/download/<filename>')
 def download_file(filename):
     try:
+        filename = secure_filename(filename)
         file_path = os.path.join('received_files', filename)
+        if os.path.isdir(os.path.join(RECEIVED_ENCRYPTED, filename)):
+            return stream_decrypted(filename)
         if not os.path.exists(file_path):
             logger.error(f"File not found: {file_path}")
             return jsonify({'status': 'error', 'message': 'File not found'}), 404
@@ -623,6 +1417,67 @@ def download_file(filename):
         logger.error(f"Error in download_file: {str(e)}")
         return jsonify({'status': 'error', 'message': 'Download failed'}), 500
 
+@app.route('/range/<filename>')
+def read_range(filename):
+    # The bytes of a received file from ?offset= on, ?length= of them (the
+    # rest of the file without one). A kept archive only has the pieces
+    # covering them decrypted, so a preview or a seek costs no full restore.
+    try:
+        filename = secure_filename(filename)
+        offset = request.args.get('offset', 0, type=int)
+        length = request.args.get('length', type=int)
+        if offset is None or offset < 0 or ('length' in request.args and (length is None or length < 0)):
+            return jsonify({'status': 'error', 'message': 'Offset and length must be non-negative integers'}), 400
+
+        entry = os.path.join(RECEIVED_ENCRYPTED, filename)
+        file_path = os.path.join('received_files', filename)
+        if os.path.isdir(entry):
+            file_size = int(dec.read_meta(entry)['file_size'])
+        elif os.path.exists(file_path):
+            file_size = os.path.getsize(file_path)
+        else:
+            logger.error(f"File not found: {filename}")
+            return jsonify({'status': 'error', 'message': 'File not found'}), 404
+
+        start = min(offset, file_size)
+        stop = file_size if length is None else min(offset + length, file_size)
+        if os.path.isdir(entry):
+            chunks = dec.iter_range(entry, start, stop, workers=app.config['CRYPTO_WORKERS'])
+        else:
+            chunks = iter_file_range(file_path, start, stop)
+
+        headers = {'Content-Length': str(stop - start), 'X-File-Size': str(file_size)}
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        return Response(stream_with_context(chunks), headers=headers, mimetype=mimetype)
+    except Exception as e:
+        logger.error(f"Error in read_range: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Reading the range failed'}), 500
+
+@app.route('/verify/<filename>')
+def verify_kept(filename):
+    # Check a kept encrypted archive against its piece table without
+    # decrypting anything
+    try:
+        filename = secure_filename(filename)
+        entry = os.path.join(RECEIVED_ENCRYPTED, filename)
+        if not os.path.isdir(entry):
+            logger.error(f"Archive not found: {entry}")
+            return jsonify({'status': 'error', 'message': 'Archive not found'}), 404
+        try:
+            checked = dec.verify(entry, workers=app.config['CRYPTO_WORKERS'])
+        except ValueError as e:
+            logger.error(f"Archive {filename} is damaged: {str(e)}")
+            return jsonify({'status': 'error', 'message': f'Verification failed: {str(e)}'}), 409
+        if checked is None:
+            return jsonify({'status': 'success', 'message': 'Archive has no piece table to check', 'pieces': None})
+        return jsonify({'status': 'success', 'message': f'All {checked} pieces are intact', 'pieces': checked})
+    except Exception as e:
+        logger.error(f"Error in verify_kept: {str(e)}")
+        return jsonify({'status': 'error', 'message': 'Verification failed'}), 500
+
+# Resume the transfers that were in flight when the server last stopped
+load_transfers()
+
 if __name__ == '__main__':
     logger.info("Starting Flask application...")
     app.run(host='0.0.0.0', port=8000, debug=True, threaded=True)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""Throughput benchmark for the split/encrypt and decrypt/restore pipeline.
+
+Runs in a scratch directory, so the working folders of the app are not touched:
+
+    python benchmark.py --size 16 --chunks 16 32 64 256 1024 4096 adaptive
+    python benchmark.py --setup --chunks 4 32 256
+    python benchmark.py --ciphers
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import divider
+import encrypter as enc
+import decrypter as dec
+import schedule
+from ciphers import CipherContext, format_schedule
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def bench_chunk_sizes(file_size, chunk_sizes, workers=1, repeat=3):
+    """Yield (label, chapters, encrypt MB/s, decrypt MB/s) for every chunk size."""
+    source = os.path.join('uploads', 'bench.bin')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(file_size))
+    megabytes = file_size / (1024 * 1024)
+
+    for chunk_size in chunk_sizes:
+        best_enc = best_dec = float('inf')
+        for _ in range(repeat):
+            _, seconds = timed(enc.encrypt_stream, source, workers=workers, chunk_size=chunk_size)
+            best_enc = min(best_enc, seconds)
+            _, seconds = timed(dec.decrypter, workers=workers, output=os.path.join('restored_file', 'bench.bin'))
+            best_dec = min(best_dec, seconds)
+        size = chunk_size or divider.adaptive_chunk_size(file_size)
+        label = '%d KB%s' % (size // 1024, '' if chunk_size else ' (adaptive)')
+        chapters = -(-file_size // size)
+        yield label, chapters, megabytes / best_enc, megabytes / best_dec
+
+def bench_cipher_setup(chunk_sizes, pieces=2000):
+    """Yield (label, per-piece setup us/piece, shared context us/piece) for every chunk size."""
+    keys = enc.generate_keys()
+    for chunk_size in chunk_sizes:
+        raw = os.urandom(chunk_size)
+        shared = CipherContext(keys)
+        _, fresh_seconds = timed(lambda: [CipherContext(keys).encrypt(i, raw) for i in range(pieces)])
+        _, shared_seconds = timed(lambda: [shared.encrypt(i, raw) for i in range(pieces)])
+        yield '%d KB' % (chunk_size // 1024), fresh_seconds / pieces * 1e6, shared_seconds / pieces * 1e6
+
+def bench_ciphers():
+    """Yield (algorithm, MB/s, raw pieces MB/s) per slot, then the schedules the benchmark policy picks."""
+    names = ('Fernet / raw AES-GCM', 'ChaCha20-Poly1305', 'AES-GCM', 'AES-CCM')
+    speeds, raw_speeds = schedule.measure(False), schedule.measure(True)
+    for slot, name in enumerate(names):
+        yield name, '%.1f' % speeds[slot], '%.1f' % raw_speeds[slot]
+    yield 'schedule', format_schedule(schedule.weighted(speeds)), format_schedule(schedule.weighted(raw_speeds))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=float, default=16, help='test file size in MB')
+    parser.add_argument('--chunks', nargs='+', default=['16', '32', '64', '256', '1024', '4096', 'adaptive'],
+                        help="chunk sizes in KB, or 'adaptive'")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--setup', action='store_true',
+                        help='measure cipher setup per piece against one shared context')
+    parser.add_argument('--ciphers', action='store_true',
+                        help='measure every algorithm and show the schedule weighted by it')
+    args = parser.parse_args()
+
+    if args.ciphers:
+        print('%-22s %18s %18s' % ('algorithm', 'MB/s', 'raw pieces MB/s'))
+        for row in bench_ciphers():
+            print('%-22s %18s %18s' % row)
+        return
+
+    chunk_sizes = [None if c == 'adaptive' else int(c) * 1024 for c in args.chunks]
+    if args.setup:
+        print('%-10s %18s %18s' % ('chunk', 'per piece us', 'shared ctx us'))
+        for row in bench_cipher_setup([c or divider.MAX for c in chunk_sizes]):
+            print('%-10s %18.1f %18.1f' % row)
+        return
+
+    here = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='nps-bench-')
+    try:
+        os.chdir(scratch)
+        for directory in ('uploads', 'files', 'encrypted', 'key', 'raw_data', 'restored_file'):
+            os.makedirs(directory)
+        print('%-18s %9s %14s %14s' % ('chunk', 'chapters', 'encrypt MB/s', 'decrypt MB/s'))
+        for row in bench_chunk_sizes(int(args.size * 1024 * 1024), chunk_sizes, args.workers, args.repeat):
+            print('%-18s %9d %14.1f %14.1f' % row)
+    finally:
+        os.chdir(here)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import base64
+import hashlib
+import os
+import struct
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305, AESGCM, AESCCM
+
+AAD = b"authenticated but unencrypted data"
+
+# Raw pieces in the Fernet slot are RAW_TAG, a 12 byte nonce and AES-GCM
+# ciphertext. Fernet tokens always start with b'g' (base64 of their 0x80
+# version byte), so the first byte tells the two formats apart.
+RAW_TAG = b'\x01'
+
+# encrypt_into/decrypt_into only exist in newer releases of cryptography
+HAS_INTO = hasattr(AESGCM, 'encrypt_into')
+
+def ccm_nonce(nonce13, length):
+    """Shorten the CCM nonce so its length field can hold a chapter of `length` bytes.
+
+    AES-CCM with a 13 byte nonce only takes messages below 64 KB; every byte
+    dropped from the nonce widens the length field by a byte.
+    """
+    length_bytes = max(2, (length.bit_length() + 7) // 8)
+    return nonce13[:15 - length_bytes]
+
+def seal_aead(aead, nonce, raw, out=None):
+    """AEAD encrypt raw, into the reusable buffer `out` when there is one.
+
+    raw may be a memoryview; the returned value is then a view of `out` that
+    is only valid until the buffer is used again.
+    """
+    if out is not None and HAS_INTO:
+        view = memoryview(out)[:len(raw) + 16]
+        aead.encrypt_into(nonce, raw, AAD, view)
+        return view
+    return aead.encrypt(nonce, bytes(raw), AAD)
+
+def open_aead(aead, nonce, raw, out=None):
+    """AEAD decrypt raw, into the reusable buffer `out` when there is one."""
+    if out is not None and HAS_INTO:
+        view = memoryview(out)[:len(raw) - 16]
+        aead.decrypt_into(nonce, raw, AAD, view)
+        return view
+    return aead.decrypt(nonce, bytes(raw), AAD)
+
+def raw_key(fernet_key):
+    """Derive the AES-256-GCM key for raw pieces from a Fernet key."""
+    return HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b'NPS raw piece'
+    ).derive(base64.urlsafe_b64decode(fernet_key))
+
+# Pieces of content-defined archives use convergent encryption: the key is a
+# hash of the plaintext, so equal pieces give equal ciphertext and can be
+# stored and sent once. That also shows an observer which pieces are equal.
+# The keys go into a recipe that is sealed with the job's own keys.
+CONVERGENT = b'NPS convergent piece'
+RECIPE_ENTRY = struct.Struct('>I32s')
+
+def convergent_aead(key, length):
+    """Return the AEAD and nonce for a convergent key; the key also picks the algorithm.
+
+    Every key seals exactly one plaintext, so a fixed nonce is safe.
+    """
+    choice = key[0] % 3
+    if choice == 0:
+        return ChaCha20Poly1305(key), bytes(12)
+    elif choice == 1:
+        return AESGCM(key), bytes(12)
+    return AESCCM(key), ccm_nonce(bytes(13), length)
+
+def convergent_key(raw):
+    """Return the key of a chapter: a hash of its content."""
+    digest = hashlib.sha256(CONVERGENT)
+    digest.update(raw)
+    return digest.digest()
+
+def seal_convergent(index, raw, known=None):
+    """Encrypt one chapter under a key derived from its content; return (key, ciphertext).
+
+    Chapters whose key is in known are not encrypted; their ciphertext is None.
+    """
+    key = convergent_key(raw)
+    if known is not None and key in known:
+        return key, None
+    aead, nonce = convergent_aead(key, len(raw))
+    return key, aead.encrypt(nonce, bytes(raw), AAD)
+
+def open_convergent(key, raw, out=None):
+    aead, nonce = convergent_aead(key, len(raw) - 16)
+    return open_aead(aead, nonce, raw, out)
+
+def pack_recipe(entries):
+    """Pack (length, key) per piece into the recipe of a content-defined archive."""
+    return b''.join(RECIPE_ENTRY.pack(length, key) for length, key in entries)
+
+def unpack_recipe(data):
+    """Return [(offset, length, key), ...] from a recipe."""
+    entries, offset = [], 0
+    for length, key in RECIPE_ENTRY.iter_unpack(bytes(data)):
+        entries.append((offset, length, key))
+        offset += length
+    return entries
+
+# The algorithm slots of a CipherContext. A schedule is the cycle of slots the
+# pieces of an archive go through, piece i using schedule[i % len(schedule)];
+# the metadata records it as digits, e.g. schedule=0123.
+FERNET, CHACHA, GCM, CCM = range(4)
+ROUND_ROBIN = (FERNET, CHACHA, GCM, CCM)
+
+def format_schedule(schedule):
+    return ''.join(str(slot) for slot in schedule)
+
+def parse_schedule(text):
+    """Return the schedule recorded in metadata; archives without one used ROUND_ROBIN."""
+    if not text:
+        return ROUND_ROBIN
+    if any(slot not in '0123' for slot in text):
+        raise ValueError(f"Unknown cipher schedule: {text}")
+    return tuple(int(slot) for slot in text)
+
+# How the pieces of an archive get their nonces. Archives from before
+# per-piece nonces used the job's nonce12/nonce13 for every piece; now each
+# piece's nonce is the job nonce with the piece index mixed in, so no two
+# pieces under one key share a nonce and any piece can be sealed on its own,
+# in any order, by anyone holding the keys.
+SHARED_NONCES = 'shared'
+COUNTER_NONCES = 'counter'
+
+def piece_nonce(nonce, index):
+    """Return the nonce of a piece: the job nonce with the index XORed into its first 8 bytes.
+
+    The index goes in front because ccm_nonce shortens nonces from the end.
+    """
+    head = int.from_bytes(nonce[:8], 'big') ^ index
+    return head.to_bytes(8, 'big') + nonce[8:]
+
+class CipherContext:
+    """The cipher objects of one job, set up once and shared by all its pieces.
+
+    The objects hold no per-message state, so one context can be used from
+    several threads. Process pools get the keys and rebuild the objects.
+
+    With raw=True the Fernet slot is stored as raw AES-GCM ciphertext behind a
+    13 byte header instead of a base64 token; decryption accepts both.
+    schedule gives the slot of every piece index, ROUND_ROBIN by default,
+    and nonces how each piece's nonce is made (COUNTER_NONCES by default).
+    """
+
+    def __init__(self, keys, raw=False, schedule=None, nonces=COUNTER_NONCES):
+        self.keys = keys
+        self.raw = raw
+        self.schedule = tuple(schedule or ROUND_ROBIN)
+        if nonces not in (SHARED_NONCES, COUNTER_NONCES):
+            raise ValueError(f"Unknown nonce scheme: {nonces}")
+        self.nonces = nonces
+        self.fernet = MultiFernet([Fernet(keys['key_1_1']), Fernet(keys['key_1_2'])])
+        # Same key order as MultiFernet: encrypt with the first, accept either
+        self.raw_aeads = [AESGCM(raw_key(keys['key_1_1'])), AESGCM(raw_key(keys['key_1_2']))]
+        self.chacha = ChaCha20Poly1305(keys['key_2'])
+        self.aesgcm = AESGCM(keys['key_3'])
+        self.aesccm = AESCCM(keys['key_4'])
+        self.nonce12 = keys['nonce12']
+        self.nonce13 = keys['nonce13']
+
+    def slot(self, index):
+        return self.schedule[index % len(self.schedule)]
+
+    def nonce(self, index, nonce):
+        if self.nonces == COUNTER_NONCES:
+            return piece_nonce(nonce, index)
+        return nonce
+
+    def encrypt(self, index, raw, out=None):
+        """Encrypt one chapter with the algorithm the schedule gives its index."""
+        slot = self.slot(index)
+        if slot == FERNET:
+            if self.raw:
+                nonce = os.urandom(12)
+                return RAW_TAG + nonce + seal_aead(self.raw_aeads[0], nonce, raw)
+            # Fernet only takes bytes
+            return self.fernet.encrypt(bytes(raw))
+        elif slot == CHACHA:
+            return seal_aead(self.chacha, self.nonce(index, self.nonce12), raw, out)
+        elif slot == GCM:
+            return seal_aead(self.aesgcm, self.nonce(index, self.nonce12), raw, out)
+        else:
+            return seal_aead(self.aesccm, ccm_nonce(self.nonce(index, self.nonce13), len(raw)), raw, out)
+
+    def decrypt(self, index, raw, out=None):
+        """Decrypt one piece with the algorithm its index was encrypted with."""
+        slot = self.slot(index)
+        if slot == FERNET:
+            if bytes(raw[:1]) == RAW_TAG:
+                return self.decrypt_raw(raw, out)
+            return self.fernet.decrypt(bytes(raw))
+        elif slot == CHACHA:
+            return open_aead(self.chacha, self.nonce(index, self.nonce12), raw, out)
+        elif slot == GCM:
+            return open_aead(self.aesgcm, self.nonce(index, self.nonce12), raw, out)
+        else:
+            return open_aead(self.aesccm, ccm_nonce(self.nonce(index, self.nonce13), len(raw) - 16), raw, out)
+
+    def decrypt_raw(self, raw, out=None):
+        nonce, secret_data = bytes(raw[1:13]), raw[13:]
+        for aead in self.raw_aeads[:-1]:
+            try:
+                return open_aead(aead, nonce, secret_data, out)
+            except InvalidTag:
+                pass
+        return open_aead(self.raw_aeads[-1], nonce, secret_data, out)
+
+    def __getstate__(self):
+        return self.keys, self.raw, self.schedule, self.nonces
+
+    def __setstate__(self, state):
+        self.__init__(*state)
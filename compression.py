@@ -0,0 +1,52 @@
+import collections
+import lzma
+import math
+import zlib
+
+# Every compressed chapter starts with a codec byte, so each piece can be
+# stored the way that suits it and still be read back without extra state.
+STORED, ZLIB, LZMA = 0, 1, 2
+CODECS = {'zlib': ZLIB, 'lzma': LZMA}
+
+SAMPLE = 4096  # Bytes looked at to estimate a chapter's entropy
+MAX_ENTROPY = 7.5  # Bits per byte above which data is taken as already compressed
+
+def entropy(data):
+    """Return the Shannon entropy of data in bits per byte."""
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in collections.Counter(data).values())
+
+def sample(data):
+    """Return a few spread out slices of data, enough to judge its entropy."""
+    if len(data) <= SAMPLE:
+        return bytes(data)
+    step = len(data) // 4
+    return b''.join(bytes(data[offset:offset + SAMPLE // 4]) for offset in range(0, step * 4, step))
+
+def compress(data, codec='zlib'):
+    """Return the chapter as a codec byte and its payload.
+
+    Chapters that look random, such as JPEG or zip data, are stored as they
+    are, and so is any chapter the codec fails to shrink.
+    """
+    if entropy(sample(data)) < MAX_ENTROPY:
+        if CODECS[codec] == LZMA:
+            packed = lzma.compress(data, preset=1)
+        else:
+            packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            return bytes([CODECS[codec]]) + packed
+    return bytes([STORED]) + bytes(data)
+
+def decompress(data):
+    """Undo compress()."""
+    codec, payload = data[0], data[1:]
+    if codec == STORED:
+        return payload
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == LZMA:
+        return lzma.decompress(payload)
+    raise ValueError(f"Unknown compression codec: {codec}")
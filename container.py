@@ -0,0 +1,232 @@
+import os
+import mmap
+import hashlib
+import struct
+import threading
+import tools
+
+# Layout of a packed container:
+#
+#   header   MAGIC, version
+#   pieces   the encrypted pieces, back to back
+#   index    (offset, length) for every piece
+#   trailer  index offset, piece count, MAGIC
+#
+# The index goes after the pieces so the writer can stream pieces of unknown
+# count and size; readers find it through the fixed size trailer.
+MAGIC = b'NPSC'
+VERSION = 1
+PACK_NAME = 'SECRET.pack'
+
+HEADER = struct.Struct('>4sB')
+ENTRY = struct.Struct('>QI')
+TRAILER = struct.Struct('>QI4s')
+
+def piece_entry(data):
+    """Return the (length, SHA-256) a piece table records for a piece."""
+    return len(data), hashlib.sha256(data).digest()
+
+class ContainerWriter:
+    """Append encrypted pieces to a single container file.
+
+    With hashed, table collects the (length, SHA-256) of every piece for the
+    key blob, so the pieces can be verified before they are decrypted.
+    """
+
+    def __init__(self, path, hashed=False):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.offset = HEADER.size
+        self.index = []
+        self.table = [] if hashed else None
+
+    def add(self, data, entry=None):
+        """Append one piece and return its index.
+
+        entry is what the piece table records instead of the piece's own
+        length and digest, for a piece left out that the receiver holds.
+        """
+        self.file.write(data)
+        self.index.append((self.offset, len(data)))
+        self.offset += len(data)
+        if self.table is not None:
+            self.table.append(entry or piece_entry(data))
+        return len(self.index) - 1
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self.file.closed:
+            return
+        for offset, length in self.index:
+            self.file.write(ENTRY.pack(offset, length))
+        self.file.write(TRAILER.pack(self.offset, len(self.index), MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DirectoryWriter:
+    """The ContainerWriter interface over the old one-file-per-piece layout."""
+
+    def __init__(self, directory, hashed=False):
+        self.directory = directory
+        self.count = 0
+        self.table = [] if hashed else None
+
+    def add(self, data, entry=None):
+        with open(os.path.join(self.directory, 'SECRET%07d' % self.count), 'wb') as target_file:
+            target_file.write(data)
+        if self.table is not None:
+            self.table.append(entry or piece_entry(data))
+        self.count += 1
+        return self.count - 1
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class Container:
+    """Random access to the pieces of a container file through its index."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size + TRAILER.size:
+                raise ValueError(f"Truncated container: {path}")
+            magic, version = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"Not a packed container: {path}")
+            if version != VERSION:
+                raise ValueError(f"Unsupported container version: {version}")
+            f.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, count, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f"Truncated container: {path}")
+            if index_offset + count * ENTRY.size != size - TRAILER.size:
+                raise ValueError(f"Truncated container index: {path}")
+            f.seek(index_offset)
+            raw_index = f.read(count * ENTRY.size)
+        self.index = [ENTRY.unpack_from(raw_index, i * ENTRY.size) for i in range(count)]
+        # Every piece has to lie between the header and the index
+        if any(offset < HEADER.size or offset + length > index_offset for offset, length in self.index):
+            raise ValueError(f"Corrupt container index: {path}")
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def length(self, index):
+        return self.index[index][1]
+
+    def view(self, index):
+        """Return one piece as a zero-copy memoryview of the mapped container."""
+        offset, length = self.index[index]
+        with self._lock:
+            if self._map is None:
+                with open(self.path, 'rb') as f:
+                    self._map = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        return self._map[offset:offset + length]
+
+    def read(self, index):
+        """Return the bytes of one piece; safe to call from several threads."""
+        offset, length = self.index[index]
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        if hasattr(os, 'pread'):
+            return os.pread(self._fd, length, offset)
+        with self._lock:
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.read(self._fd, length)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._map is not None:
+            mapped = self._map.obj
+            self._map.release()
+            self._map = None
+            try:
+                mapped.close()
+            except BufferError:
+                # A caller still holds a piece; the mapping goes with it
+                pass
+
+    def __getstate__(self):
+        # File descriptors and locks don't cross process boundaries; the
+        # receiving process reopens the file on its first read
+        return {'path': self.path, 'index': self.index}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._fd = None
+        self._map = None
+        self._lock = threading.Lock()
+
+class DirectoryPieces:
+    """The same interface over the old one-file-per-piece layout."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Pieces still being received end in .part and don't count yet
+        self.names = sorted(name for name in tools.list_dir(directory) if not name.endswith('.part'))
+
+    def __len__(self):
+        return len(self.names)
+
+    def length(self, index):
+        return os.path.getsize(os.path.join(self.directory, self.names[index]))
+
+    def read(self, index):
+        with open(os.path.join(self.directory, self.names[index]), 'rb') as file:
+            return file.read()
+
+    view = read
+
+    def close(self):
+        pass
+
+def pack_directory(directory='encrypted'):
+    """Pack the one-file-per-piece layout in directory into a container.
+
+    The piece files are removed once they are in the container. Returns the
+    number of pieces packed.
+    """
+    pieces = DirectoryPieces(directory)
+    with ContainerWriter(os.path.join(directory, PACK_NAME)) as writer:
+        for index in range(len(pieces)):
+            writer.add(pieces.read(index))
+    for name in pieces.names:
+        os.remove(os.path.join(directory, name))
+    return len(pieces)
+
+def open_writer(directory='encrypted', packed=True, hashed=False):
+    """Return a writer for new pieces, a container or a piece per file."""
+    if packed:
+        return ContainerWriter(os.path.join(directory, PACK_NAME), hashed)
+    return DirectoryWriter(directory, hashed)
+
+def open_pieces(directory='encrypted'):
+    """Open the pieces in directory, packed or not."""
+    path = os.path.join(directory, PACK_NAME)
+    if os.path.exists(path):
+        return Container(path)
+    return DirectoryPieces(directory)
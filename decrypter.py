@@ -1,11 +1,15 @@
 import tools
 import base64
-from cryptography.fernet import Fernet, MultiFernet
-from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305, AESGCM, AESCCM
+from cryptography.fernet import Fernet
 import os
-from flask import jsonify
+import functools
+import container
+import bisect
+import compression
+import keyblob
+from ciphers import SHARED_NONCES, CipherContext, open_convergent, parse_schedule, unpack_recipe
 
-def Algo1(key):
+def Algo1(key, path="raw_data/store_in_me.enc"):
     try:
         # Ensure key is in the correct format
         if isinstance(key, str):
@@ -31,184 +35,361 @@ def Algo1(key):
             raise ValueError("Invalid key length. Key must be 32 bytes when decoded.")
         
         f = Fernet(key)
-        with open("raw_data/store_in_me.enc", "rb") as target_file:
+        with open(path, "rb") as target_file:
             secret_data = target_file.read()
         data = f.decrypt(secret_data)
         return data
     except Exception as e:
         raise ValueError(f"Decryption failed: {str(e)}")
 
-def Algo1_extented(filename, key1, key2):
-    try:
-        # Ensure keys are in the correct format
-        if isinstance(key1, str):
-            key1 = key1.encode()
-        if isinstance(key2, str):
-            key2 = key2.encode()
-            
-        # If keys are not in PEM format, try to decode them as base64
-        if not key1.startswith(b'-----BEGIN'):
-            try:
-                decoded_key1 = base64.urlsafe_b64decode(key1)
-                key1 = base64.urlsafe_b64encode(decoded_key1)
-            except:
-                key1 = base64.urlsafe_b64encode(key1)
-                
-        if not key2.startswith(b'-----BEGIN'):
-            try:
-                decoded_key2 = base64.urlsafe_b64decode(key2)
-                key2 = base64.urlsafe_b64encode(decoded_key2)
-            except:
-                key2 = base64.urlsafe_b64encode(key2)
-            
-        f = MultiFernet([Fernet(key1), Fernet(key2)])
-        source_filename = 'encrypted/' + filename
-        target_filename = 'files/' + filename
+def read_key_store(root='.'):
+    """Read the user key from key/ and unseal the algorithm keys, nonces and metadata.
 
-        with open(source_filename, 'rb') as file:
-            raw = file.read()
-        secret_data = f.decrypt(raw)
+    Returns (keys, meta). Archives from before the key blob keep their keys
+    as ':::::' joined base64 and their metadata in raw_data/meta_data.txt.
+    """
+    # Load encrypted key data from key/ directory
+    list_directory = tools.list_dir(os.path.join(root, 'key'))
+    if not list_directory:
+        raise ValueError("No key file found in key directory")
         
-        with open(target_filename, 'wb') as target_file:
-            target_file.write(secret_data)
+    filename = os.path.join(root, 'key', list_directory[0])
+    with open(filename, "rb") as public_key:
+        key_1 = public_key.read()
+
+    # Ensure key is in the correct format
+    if not key_1.startswith(b'-----BEGIN'):
+        try:
+            decoded_key = base64.urlsafe_b64decode(key_1)
+            key_1 = base64.urlsafe_b64encode(decoded_key)
+        except:
+            key_1 = base64.urlsafe_b64encode(key_1)
+
+    # Decrypt the key information
+    try:
+        secret_information = Algo1(key_1, os.path.join(root, 'raw_data', 'store_in_me.enc'))
     except Exception as e:
-        raise ValueError(f"Decryption failed for {filename}: {str(e)}")
+        raise ValueError(f"Failed to decrypt key information: {str(e)}")
+
+    if keyblob.is_blob(secret_information):
+        return keyblob.unpack(secret_information)
 
-def Algo2(filename, key, nonce):
     try:
-        aad = b"authenticated but unencrypted data"
-        chacha = ChaCha20Poly1305(key)
-        source_filename = 'encrypted/' + filename
-        target_filename = 'files/' + filename
+        list_information = secret_information.split(b':::::')
+    except Exception as e:
+        raise ValueError(f"Failed to parse key information: {str(e)}")
 
-        with open(source_filename, 'rb') as file:
-            raw = file.read()
-        secret_data = chacha.decrypt(nonce, raw, aad)
+    if len(list_information) != 7:
+        raise ValueError("Invalid key information format")
 
-        with open(target_filename, 'wb') as target_file:
-            target_file.write(secret_data)
+    try:
+        # Decode base64 values back into original binary keys and nonces
+        names = ('key_1_1', 'key_1_2', 'key_2', 'key_3', 'key_4', 'nonce12', 'nonce13')
+        keys = {name: base64.urlsafe_b64decode(value)
+                for name, value in zip(names, list_information)}
     except Exception as e:
-        raise ValueError(f"Decryption failed for {filename}: {str(e)}")
+        raise ValueError(f"Failed to decode key components: {str(e)}")
+    return keys, tools.read_meta_data(os.path.join(root, 'raw_data', 'meta_data.txt'))
+
+def read_meta(root='.'):
+    """Return the metadata of the archive under root."""
+    return read_key_store(root)[1]
+
+def check_digest(index, entry, pieces):
+    """Compare the SHA-256 of one piece with its piece table entry; safe to run in a worker."""
+    if container.piece_entry(pieces.view(index))[1] != entry[1]:
+        raise ValueError(f"Piece {index} does not match its digest")
+
+def verify_pieces(pieces, table, workers=1):
+    """Check the pieces against a piece table of (length, SHA-256) entries.
+
+    All lengths are compared first, which finds a truncated transfer
+    without reading any data, then the digests, on a pool of `workers`.
+    Raises ValueError at the first piece that doesn't match.
+    """
+    if len(pieces) != len(table):
+        raise ValueError(f"Found {len(pieces)} pieces, the piece table lists {len(table)}")
+    for index, (length, _) in enumerate(table):
+        if pieces.length(index) != length:
+            raise ValueError(f"Piece {index} is {pieces.length(index)} bytes, expected {length}")
+
+    check = functools.partial(check_digest, pieces=pieces)
+    if workers > 1:
+        # hashlib lets go of the GIL, so threads hash in parallel
+        with tools.make_pool(workers) as pool:
+            for _ in tools.bounded_map(pool, check, table, workers * 2):
+                pass
+    else:
+        for index, entry in enumerate(table):
+            check(index, entry)
+
+def verify(root='.', workers=1):
+    """Check the pieces of the archive under root against the piece table in its key blob.
 
-def Algo3(filename, key, nonce):
+    Nothing is decrypted or written, so a damaged or truncated transfer is
+    caught before any work goes into it. Raises ValueError naming the first
+    bad piece; returns the number of pieces checked, or None for archives
+    made before piece tables, which have nothing to check against.
+    """
+    meta = read_meta(root)
+    if 'pieces' not in meta:
+        return None
+    pieces = container.open_pieces(os.path.join(root, 'encrypted'))
     try:
-        aad = b"authenticated but unencrypted data"
-        aesgcm = AESGCM(key)
-        source_filename = 'encrypted/' + filename
-        target_filename = 'files/' + filename
+        verify_pieces(pieces, meta['pieces'], workers)
+    finally:
+        pieces.close()
+    return len(meta['pieces'])
 
-        with open(source_filename, 'rb') as file:
-            raw = file.read()
-        secret_data = aesgcm.decrypt(nonce, raw, aad)
+def decrypt_to_offset(index, pieces, ctx, output, chunk_size, first=0, compressed=False):
+    """Decrypt one piece straight into its place in the output file.
 
-        with open(target_filename, 'wb') as target_file:
-            target_file.write(secret_data)
+    first is the piece the file starts at, for files packed in a batch;
+    compressed pieces are decompressed before they are written.
+    """
+    try:
+        raw = pieces.view(index)
+        plain = ctx.decrypt(index, raw, tools.thread_buffer(len(raw)))
+        if compressed:
+            plain = compression.decompress(plain)
+        tools.write_at(output, (index - first) * chunk_size, plain)
+        return len(plain)
     except Exception as e:
-        raise ValueError(f"Decryption failed for {filename}: {str(e)}")
+        raise ValueError(f"Decryption failed for piece {index}: {str(e)}")
 
-def Algo4(filename, key, nonce):
+def decrypt_to_files(index, pieces, ctx, root='.', compressed=False):
+    """Decrypt one piece into files/SECRETnnnnnnn for restore.restore()."""
     try:
-        aad = b"authenticated but unencrypted data"
-        aesccm = AESCCM(key)
-        source_filename = 'encrypted/' + filename
-        target_filename = 'files/' + filename
+        raw = pieces.view(index)
+        plain = ctx.decrypt(index, raw, tools.thread_buffer(len(raw)))
+        if compressed:
+            plain = compression.decompress(plain)
+        with open(os.path.join(root, 'files', 'SECRET%07d' % index), 'wb') as target_file:
+            target_file.write(plain)
+        return len(plain)
+    except Exception as e:
+        raise ValueError(f"Decryption failed for piece {index}: {str(e)}")
 
-        with open(source_filename, 'rb') as file:
-            raw = file.read()
-        secret_data = aesccm.decrypt(nonce, raw, aad)
+def decrypt_convergent(index, pieces, recipe, output=None, root='.'):
+    """Decrypt one piece of a content-defined archive with its key from the recipe.
 
-        with open(target_filename, 'wb') as target_file:
-            target_file.write(secret_data)
+    The plaintext goes to its offset in output, or to files/ without one.
+    """
+    try:
+        offset, length, key = recipe[index]
+        plain = open_convergent(key, pieces.view(index), tools.thread_buffer(length))
+        if output is not None:
+            tools.write_at(output, offset, plain)
+        else:
+            with open(os.path.join(root, 'files', 'SECRET%07d' % index), 'wb') as target_file:
+                target_file.write(plain)
+        return len(plain)
     except Exception as e:
-        raise ValueError(f"Decryption failed for {filename}: {str(e)}")
+        raise ValueError(f"Decryption failed for piece {index}: {str(e)}")
+
+def read_recipe(ctx, pieces, meta):
+    """Return the (offset, length, key) entries of a content-defined archive, or None.
+
+    The recipe is the last piece, sealed with the job keys like any other.
+    """
+    if meta.get('chunking') != 'cdc':
+        return None
+    index = len(pieces) - 1
+    recipe = unpack_recipe(ctx.decrypt(index, pieces.view(index)))
+    if len(recipe) != index:
+        raise ValueError("Recipe does not match the pieces")
+    return recipe
+
+def open_archive(root='.'):
+    """Return the cipher context, the pieces and the metadata of the archive under root.
 
-def decrypter():
+    root holds the same key/, raw_data/ and encrypted/ folders a job uses.
+    """
+    keys, meta = read_key_store(root)
+    ctx = CipherContext(keys, schedule=parse_schedule(meta.get('schedule')),
+                        nonces=meta.get('nonces', SHARED_NONCES))
+    pieces = container.open_pieces(os.path.join(root, 'encrypted'))
+    return ctx, pieces, meta
+
+def iter_range(root='.', start=0, stop=None, workers=1):
+    """Yield the plaintext of bytes [start, stop) of the archive under root.
+
+    Only the pieces covering the range are read and decrypted, so nothing
+    else of the archive is touched. With workers > 1 the next pieces are
+    decrypted on a pool while earlier ones are consumed; at most about
+    workers * 2 pieces are held in memory, one otherwise.
+    """
+    ctx, pieces, meta = open_archive(root)
     try:
-        tools.empty_folder('files')
+        recipe = read_recipe(ctx, pieces, meta)
+        if recipe is None and 'chunk_size' not in meta:
+            raise ValueError("Archive has no chunk size, it can only be restored whole")
+        file_size = int(meta['file_size'])
+        stop = file_size if stop is None else min(stop, file_size)
+        if start >= stop:
+            return
 
-        # Load encrypted key data from key/ directory
-        list_directory = tools.list_dir('key')
-        if not list_directory:
-            raise ValueError("No key file found in key directory")
-            
-        filename = './key/' + list_directory[0]
-        with open(filename, "rb") as public_key:
-            key_1 = public_key.read()
+        if recipe is not None:
+            # Content-defined pieces: find the covering ones by their offsets
+            offsets = [offset for offset, _, _ in recipe]
+            first = bisect.bisect_right(offsets, start) - 1
+            last = bisect.bisect_right(offsets, stop - 1) - 1
+        else:
+            chunk_size = int(meta['chunk_size'])
+            first, last = start // chunk_size, (stop - 1) // chunk_size
 
-        # Ensure key is in the correct format
-        if not key_1.startswith(b'-----BEGIN'):
-            try:
-                decoded_key = base64.urlsafe_b64decode(key_1)
-                key_1 = base64.urlsafe_b64encode(decoded_key)
-            except:
-                key_1 = base64.urlsafe_b64encode(key_1)
+        def plain_range(_, index):
+            if recipe is not None:
+                piece_start, _, key = recipe[index]
+                plain = open_convergent(key, pieces.view(index))
+            else:
+                piece_start = index * chunk_size
+                plain = ctx.decrypt(index, pieces.view(index))
+                if 'compression' in meta:
+                    plain = compression.decompress(plain)
+            return bytes(plain[max(start - piece_start, 0):stop - piece_start])
+
+        indexes = range(first, last + 1)
+        if workers > 1 and len(indexes) > 1:
+            with tools.make_pool(workers) as pool:
+                yield from tools.bounded_map(pool, plain_range, indexes, workers * 2)
+        else:
+            for index in indexes:
+                yield plain_range(None, index)
+    finally:
+        pieces.close()
 
-        # Decrypt the key information
+def decrypt_range(offset, length, root='.', workers=1):
+    """Return `length` bytes of the plaintext from `offset` on, without restoring the file.
+
+    Only the pieces the range falls in are decrypted. Like a file's read(),
+    a range running past the end of the file comes back short.
+    """
+    if offset < 0 or length < 0:
+        raise ValueError("Offset and length must not be negative")
+    return b''.join(iter_range(root, offset, offset + length, workers))
+
+def decrypter(workers=1, processes=False, output=None, root='.', progress=None, check=True):
+    """Decrypt every piece in encrypted/, packed in a container or one per file.
+
+    By default the pieces are written to files/ for restore.restore() to join.
+    When an output path is given and the metadata records the chunk size, each
+    piece is instead written at its offset in a preallocated output file, on a
+    pool of `workers`, and the output path is returned. All folders are taken
+    relative to root, a job workspace or the app directory. progress, when
+    given, is called as progress(index, nbytes, total) after every piece.
+
+    With check, the pieces are first verified against the piece table in
+    the key blob, so a damaged archive fails before anything is written.
+    """
+    try:
+        # The keys are unsealed and the ciphers set up once for all pieces
+        ctx, pieces, meta = open_archive(root)
         try:
-            secret_information = Algo1(key_1)
-        except Exception as e:
-            raise ValueError(f"Failed to decrypt key information: {str(e)}")
+            if not len(pieces):
+                raise ValueError("No encrypted files found")
+            if check and 'pieces' in meta:
+                verify_pieces(pieces, meta['pieces'], workers)
+        except Exception:
+            pieces.close()
+            raise
+
+        tools.empty_folder(os.path.join(root, 'files'))
+        recipe = read_recipe(ctx, pieces, meta)
+        if recipe is not None:
+            if output is not None:
+                with open(output, 'wb') as target_file:
+                    target_file.truncate(int(meta['file_size']))
+            task = functools.partial(decrypt_convergent, pieces=pieces, recipe=recipe,
+                                     output=output, root=root)
+        elif output is not None and 'chunk_size' in meta:
+            with open(output, 'wb') as target_file:
+                target_file.truncate(int(meta['file_size']))
+            task = functools.partial(decrypt_to_offset, pieces=pieces, ctx=ctx,
+                                     output=output, chunk_size=int(meta['chunk_size']),
+                                     compressed='compression' in meta)
+        else:
+            task = functools.partial(decrypt_to_files, pieces=pieces, ctx=ctx, root=root,
+                                     compressed='compression' in meta)
+            output = None
 
+        total = len(pieces) if recipe is None else len(recipe)
         try:
-            list_information = secret_information.split(b':::::')
-        except Exception as e:
-            raise ValueError(f"Failed to parse key information: {str(e)}")
+            if workers > 1:
+                with tools.make_pool(workers, processes) as pool:
+                    futures = [pool.submit(task, index) for index in range(total)]
+                    try:
+                        for index, future in enumerate(futures):
+                            nbytes = future.result()
+                            if progress is not None:
+                                progress(index, nbytes, total)
+                    except BaseException:
+                        # Don't leave queued pieces running after a failure
+                        for future in futures:
+                            future.cancel()
+                        raise
+            else:
+                for index in range(total):
+                    nbytes = task(index)
+                    if progress is not None:
+                        progress(index, nbytes, total)
+        finally:
+            pieces.close()
+        return output
 
-        if len(list_information) != 7:
-            raise ValueError("Invalid key information format")
+    except Exception as e:
+        raise ValueError(f"Decryption process failed: {str(e)}")
+
+def run_task(_, task):
+    return task()
+
+def decrypt_batch(output_dir, workers=1, processes=False, root='.', progress=None, check=True):
+    """Decrypt every file of a batch archive into output_dir; return their paths.
 
+    The pieces of all files go through one pool, each written straight to
+    its offset in its preallocated output file. check works as in decrypter().
+    """
+    try:
+        ctx, pieces, meta = open_archive(root)
         try:
-            # Decode base64 values back into original binary keys and nonces
-            key_1_1 = base64.urlsafe_b64decode(list_information[0])
-            key_1_2 = base64.urlsafe_b64decode(list_information[1])
-            key_2   = base64.urlsafe_b64decode(list_information[2])
-            key_3   = base64.urlsafe_b64decode(list_information[3])
-            key_4   = base64.urlsafe_b64decode(list_information[4])
-            nonce12 = base64.urlsafe_b64decode(list_information[5])
-            nonce13 = base64.urlsafe_b64decode(list_information[6])
-        except Exception as e:
-            raise ValueError(f"Failed to decode key components: {str(e)}")
-
-        files = sorted(tools.list_dir('encrypted'))
-        if not files:
-            raise ValueError("No encrypted files found")
-
-        for index in range(len(files)):
-            try:
-                if index % 4 == 0:
-                    Algo1_extented(files[index], key_1_1, key_1_2)
-                elif index % 4 == 1:
-                    Algo2(files[index], key_2, nonce12)
-                elif index % 4 == 2:
-                    Algo3(files[index], key_3, nonce12)
-                else:
-                    Algo4(files[index], key_4, nonce13)
-            except Exception as e:
-                raise ValueError(f"Failed to decrypt file {files[index]}: {str(e)}")
-                
-        # Clean the key directory before saving the new key
-        for f in os.listdir(app.config['UPLOAD_KEY']):
-            safe_remove_file(os.path.join(app.config['UPLOAD_KEY'], f))
-
-        key_path = os.path.join(app.config['UPLOAD_KEY'], 'received.key')
+            entries = tools.read_manifest(meta)
+            if entries is None:
+                raise ValueError("Archive is not a batch")
+            if check and 'pieces' in meta:
+                verify_pieces(pieces, meta['pieces'], workers)
+        except Exception:
+            pieces.close()
+            raise
+
+        outputs, tasks = [], []
+        for entry in entries:
+            # The manifest came from elsewhere; keep its names inside output_dir
+            output = os.path.join(output_dir, os.path.basename(entry['File_Name']))
+            with open(output, 'wb') as target_file:
+                target_file.truncate(entry['file_size'])
+            outputs.append(output)
+            for index in range(entry['first'], entry['first'] + entry['chapters']):
+                tasks.append(functools.partial(decrypt_to_offset, index, pieces, ctx, output,
+                                               entry['chunk_size'], entry['first'],
+                                               'compression' in meta))
+        if len(tasks) != len(pieces):
+            raise ValueError("Manifest does not match the container")
+
+        total = len(tasks)
         try:
-            if not key_1:
-                raise Exception("No key data provided")
-            
-            key_data = base64.b64decode(key_1)
-            if not key_data:
-                raise Exception("Decoded key data is empty")
-            
-            # Ensure key directory exists
-            os.makedirs(app.config['UPLOAD_KEY'], exist_ok=True)
-            
-            with open(key_path, 'wb') as f:
-                f.write(key_data)
-            logger.debug(f"Key saved to: {key_path} ({len(key_data)} bytes)")
-        except Exception as e:
-            logger.error(f"Error saving key: {str(e)}")
-            safe_remove_file(encrypted_file_raw_data_path)
-            return jsonify({'status': 'error', 'message': f'Failed to process key: {str(e)}'}), 400
-                
+            if workers > 1:
+                with tools.make_pool(workers, processes) as pool:
+                    for index, nbytes in enumerate(tools.bounded_map(pool, run_task, tasks, workers * 2)):
+                        if progress is not None:
+                            progress(index, nbytes, total)
+            else:
+                for index, task in enumerate(tasks):
+                    nbytes = task()
+                    if progress is not None:
+                        progress(index, nbytes, total)
+        finally:
+            pieces.close()
+        return outputs
+
     except Exception as e:
-        raise ValueError(f"Decryption process failed: {str(e)}")
+        raise ValueError(f"Batch decryption failed: {str(e)}")
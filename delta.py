@@ -0,0 +1,60 @@
+import os
+import re
+import struct
+from ciphers import seal_convergent
+
+# What we last sent each peer, per file name: the convergent key of every
+# chapter and the SHA-256 of its piece. A re-share of the file to that peer
+# skips encrypting and sending the chapters that are already there.
+INDEX_DIR = 'sent_index'
+ENTRY = struct.Struct('>32s32s')
+
+def index_path(peer_ip, filename, directory=INDEX_DIR):
+    # Peer addresses come from the user; keep them to safe file names
+    return os.path.join(directory, re.sub(r'[^0-9A-Za-z.-]', '_', peer_ip), filename + '.idx')
+
+def load_index(peer_ip, filename, directory=INDEX_DIR):
+    """Return {convergent key: piece digest} for the last copy of filename sent to the peer."""
+    try:
+        with open(index_path(peer_ip, filename, directory), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    return dict(ENTRY.iter_unpack(data[:len(data) - len(data) % ENTRY.size]))
+
+def save_index(peer_ip, filename, entries, directory=INDEX_DIR):
+    """Replace the index of filename for the peer with (key, digest) entries."""
+    path = index_path(peer_ip, filename, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.part', 'wb') as f:
+        for key, digest in entries:
+            f.write(ENTRY.pack(key, digest))
+    os.replace(path + '.part', path)
+
+class DeltaPieces:
+    """The pieces of a delta archive, with the skipped ones sealed on demand.
+
+    Pieces left empty because the peer should hold them are encrypted from
+    the source file when they are read after all, e.g. because the peer
+    has lost them since.
+    """
+
+    def __init__(self, pieces, recipe, source):
+        self.pieces = pieces
+        self.recipe = recipe
+        self.source = source
+
+    def __len__(self):
+        return len(self.pieces)
+
+    def read(self, index):
+        data = self.pieces.read(index)
+        if data or index >= len(self.recipe):
+            return data
+        offset, length, key = self.recipe[index]
+        with open(self.source, 'rb') as f:
+            f.seek(offset)
+            return seal_convergent(index, f.read(length))[1]
+
+    def close(self):
+        self.pieces.close()
@@ -1,55 +1,218 @@
+import os
+import mmap
+import hashlib
 import tools
+from ciphers import format_schedule
 
-def divide():
-    tools.empty_folder('files')
-    tools.empty_folder('raw_data')
-    
-    # Get the uploaded file list
-    FILE = tools.list_dir('uploads')
-    FILE = './uploads/' + FILE[0]
+MAX = 1024 * 32  # 32 KB default and smallest chapter size
+MAX_CHUNK = 1024 * 1024 * 8  # 8 MB largest adaptive chapter size
+TARGET_CHAPTERS = 64  # Enough chapters to mix all four algorithms and fill a pool
 
-    MAX = 1024 * 32  # 32 KB max chapter size
-    BUF = 50 * 1024 * 1024  # 50 MB buffer size (adjusted for practicality)
+def upload_path(root='.'):
+    """Return the path of the file waiting in the uploads folder."""
+    FILE = tools.list_dir(os.path.join(root, 'uploads'))
+    return os.path.join(root, 'uploads', FILE[0])
 
-    chapters = 0
-    uglybuf = b''  # Use bytes for binary data
+def adaptive_chunk_size(file_size, target_chapters=TARGET_CHAPTERS):
+    """Pick a power of two chunk size that divides file_size into about target_chapters."""
+    size = MAX
+    while size < MAX_CHUNK and size * target_chapters < file_size:
+        size *= 2
+    return size
 
-    # Open meta data file for writing
-    with open('raw_data/meta_data.txt', 'w') as meta_data:
-        file__name = FILE.split('/')[-1]  # Extract file name from path
-        print(file__name)
-        meta_data.write("File_Name=%s\n" % file__name)
+def iter_chapters(FILE, size=MAX, zero_copy=False):
+    """Yield the file as consecutive chapters of at most `size` bytes.
 
-        # Read the file and divide it into parts
-        with open(FILE, 'rb') as src:
+    With zero_copy the file is memory mapped and the chapters are memoryview
+    slices of the mapping instead of freshly read bytes.
+    """
+    with open(FILE, 'rb') as src:
+        if not zero_copy or os.fstat(src.fileno()).st_size == 0:
             while True:
-                target_filename = 'files/SECRET%07d' % chapters
-                with open(target_filename, 'wb') as target_file:
-                    written = 0
-
-                    while written < MAX:
-                        if len(uglybuf) > 0:
-                            target_file.write(uglybuf)
-
-                        data = src.read(min(BUF, MAX - written))
-
-                        if not data:
-                            break
-                        
-                        target_file.write(data)
-                        written += len(data)
-                        
-                        # Read the next byte to continue the division process
-                        uglybuf = src.read(1)
-
-                        if len(uglybuf) == 0:
-                            break
-
-                # Increment chapter count and stop if end of file
-                chapters += 1
-                if len(uglybuf) == 0:
+                data = src.read(size)
+                if not data:
                     break
-        
-        # Write the number of chapters to the metadata
-        meta_data.write("chapters=%d" % (chapters + 1))
+                yield data
+            return
+
+        mapped = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            for offset in range(0, len(view), size):
+                yield view[offset:offset + size]
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # A consumer still holds a chapter; the mapping goes with it
+                pass
+
+def read_full(stream, size):
+    """Read size bytes from a stream, fewer only where the stream ends."""
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    chunks = [data]
+    remaining = size - len(data)
+    while remaining:
+        data = stream.read(remaining)
+        if not data:
+            break
+        chunks.append(data)
+        remaining -= len(data)
+    return b''.join(chunks)
+
+def iter_stream_chapters(stream, size=MAX):
+    """Yield chapters of `size` bytes from a stream as they are read."""
+    while True:
+        data = read_full(stream, size)
+        if not data:
+            return
+        yield data
+
+# Content-defined chunking, after FastCDC: a gear rolling hash over the
+# bytes picks the cut points, so an insertion only changes the chapters
+# around it and equal runs of data give equal chapters across files.
+CDC_AVG = 1024 * 64  # 64 KB average chapter
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big') for i in range(256)]
+
+def cdc_masks(avg_size):
+    """Return the stricter and the looser cut mask for an average chapter size.
+
+    The gear hash shifts left, so its high bits depend on the most bytes;
+    the masks test those. Normalized chunking cuts harder before the average
+    size and easier after it, which keeps the sizes close to the average.
+    """
+    bits = avg_size.bit_length() - 1
+    mask_s = (0xFFFFFFFF << (32 - bits - 2)) & 0xFFFFFFFF
+    mask_l = (0xFFFFFFFF << (32 - bits + 2)) & 0xFFFFFFFF
+    return mask_s, mask_l
+
+def cdc_cut(data, start, avg_size=CDC_AVG):
+    """Return the end of the chapter of data that starts at start."""
+    min_size, max_size = avg_size // 4, avg_size * 8
+    length = len(data) - start
+    if length <= min_size:
+        return len(data)
+    mask_s, mask_l = cdc_masks(avg_size)
+    normal = start + min(length, avg_size)
+    end = start + min(length, max_size)
+    gear = GEAR
+    h = 0
+    # Bytes before min_size can't end a chapter, so they are never hashed
+    for position, byte in enumerate(data[start + min_size:normal], start + min_size):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        if not h & mask_s:
+            return position + 1
+    for position, byte in enumerate(data[normal:end], normal):
+        h = ((h << 1) + gear[byte]) & 0xFFFFFFFF
+        if not h & mask_l:
+            return position + 1
+    return end
+
+def iter_cdc_chapters(FILE, avg_size=CDC_AVG):
+    """Yield the file as content-defined chapters of about avg_size bytes."""
+    with open(FILE, 'rb') as src:
+        if os.fstat(src.fileno()).st_size == 0:
+            return
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            start = 0
+            while start < len(mapped):
+                end = cdc_cut(mapped, start, avg_size)
+                yield mapped[start:end]
+                start = end
+
+def iter_stream_cdc_chapters(stream, avg_size=CDC_AVG):
+    """Yield content-defined chapters from a stream as it is read.
+
+    A cut only looks at the next avg_size * 8 bytes, so holding that much
+    gives the same chapters as iter_cdc_chapters on the whole file.
+    """
+    max_size = avg_size * 8
+    buffer = bytearray()
+    while True:
+        buffer += read_full(stream, max_size - len(buffer))
+        if not buffer:
+            return
+        end = cdc_cut(buffer, 0, avg_size)
+        yield bytes(buffer[:end])
+        del buffer[:end]
+
+def meta_data(file__name, chapters, chunk_size=MAX, file_size=None, chunking=None, compression=None,
+              schedule=None, nonces=None, pieces=None):
+    """Return the metadata of a divided file as the decrypter reads it back."""
+    meta = {'File_Name': file__name, 'chapters': str(chapters)}
+    # Every chapter but the last is exactly chunk_size bytes, so chapter
+    # i starts at i * chunk_size in the restored file. Content-defined
+    # chapters have no fixed size; their lengths are in the recipe.
+    if chunking is not None:
+        meta['chunking'] = chunking
+    # Compressed chapters carry a codec byte in front of their data
+    if compression is not None:
+        meta['compression'] = compression
+    # The cycle of algorithms the pieces were encrypted with
+    if schedule is not None:
+        meta['schedule'] = format_schedule(schedule)
+    # How the nonce of every piece was made
+    if nonces is not None:
+        meta['nonces'] = nonces
+    # The (length, SHA-256) of every piece, checked before decrypting
+    if pieces is not None:
+        meta['pieces'] = pieces
+    if chunk_size is not None:
+        meta['chunk_size'] = str(chunk_size)
+    if file_size is not None:
+        meta['file_size'] = str(file_size)
+    return meta
+
+def manifest(entries, compression=None, schedule=None, nonces=None, pieces=None):
+    """Return the metadata of a batch: one numbered set of keys per file.
+
+    Each entry has File_Name, first (its first piece in the container),
+    chapters, chunk_size and file_size.
+    """
+    meta = {'batch': str(len(entries))}
+    if compression is not None:
+        meta['compression'] = compression
+    if schedule is not None:
+        meta['schedule'] = format_schedule(schedule)
+    if nonces is not None:
+        meta['nonces'] = nonces
+    if pieces is not None:
+        meta['pieces'] = pieces
+    for number, entry in enumerate(entries):
+        for name in ('File_Name', 'first', 'chapters', 'chunk_size', 'file_size'):
+            meta['%s.%d' % (name, number)] = str(entry[name])
+    return meta
+
+def write_meta_data(meta, root='.'):
+    """Leave the metadata in raw_data/meta_data.txt for encrypter() to seal."""
+    with open(os.path.join(root, 'raw_data', 'meta_data.txt'), 'w') as meta_data:
+        for name, value in meta.items():
+            meta_data.write("%s=%s\n" % (name, value))
+
+def divide(chunk_size=None, root='.'):
+    tools.empty_folder(os.path.join(root, 'files'))
+    tools.empty_folder(os.path.join(root, 'raw_data'))
+    
+    # Get the uploaded file list
+    FILE = upload_path(root)
+    file__name = os.path.basename(FILE)  # Extract file name from path
+    print(file__name)
+
+    file_size = os.path.getsize(FILE)
+    if chunk_size is None:
+        chunk_size = adaptive_chunk_size(file_size)
+
+    chapters = 0
+
+    # Read the file and divide it into parts
+    for data in iter_chapters(FILE, chunk_size):
+        target_filename = os.path.join(root, 'files', 'SECRET%07d' % chapters)
+        with open(target_filename, 'wb') as target_file:
+            target_file.write(data)
+        chapters += 1
 
+    # Write the file name and the number of chapters to the metadata
+    write_meta_data(meta_data(file__name, chapters, chunk_size, file_size), root)
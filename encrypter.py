@@ -1,113 +1,310 @@
 import tools
+import divider
+import container
+import compression
+import keyblob
+from ciphers import CipherContext, format_schedule, seal_convergent, pack_recipe
 import os
-import base64
-from cryptography.fernet import Fernet, MultiFernet
+import functools
+from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.ciphers.aead import AESCCM
 
-def Algo1(data, key):
+def Algo1(data, key, path="raw_data/store_in_me.enc"):
     f = Fernet(key)
-    with open("raw_data/store_in_me.enc", "wb") as target_file:
+    with open(path, "wb") as target_file:
         secret_data = f.encrypt(data)
         target_file.write(secret_data)
 
-def Algo1_extented(filename, key1, key2):
-    f = MultiFernet([Fernet(key1), Fernet(key2)])
-    source_filename = 'files/' + filename
-    target_filename = 'encrypted/' + filename
+def generate_keys():
+    """Generate the per-job keys and nonces used by the four algorithms."""
+    return {
+        'key_1': Fernet.generate_key(),
+        'key_1_1': Fernet.generate_key(),
+        'key_1_2': Fernet.generate_key(),
+        'key_2': ChaCha20Poly1305.generate_key(),
+        'key_3': AESGCM.generate_key(bit_length=128),
+        'key_4': AESCCM.generate_key(bit_length=128),
+        'nonce12': os.urandom(12),
+        'nonce13': os.urandom(13),
+    }
 
-    with open(source_filename, 'rb') as file:
-        raw = file.read()  # Read entire file content
-    secret_data = f.encrypt(raw)
+def store_keys(keys, meta, root='.'):
+    """Seal the algorithm keys and the metadata with key_1 and write key_1 out as the user key."""
+    # Keys, nonces and metadata go into one binary blob
+    Algo1(keyblob.pack(keys, meta), keys['key_1'], os.path.join(root, 'raw_data', 'store_in_me.enc'))
 
-    with open(target_filename, 'wb') as target_file:
-        target_file.write(secret_data)
-
-def Algo2(filename, key, nonce):
-    aad = b"authenticated but unencrypted data"
-    chacha = ChaCha20Poly1305(key)
-    source_filename = 'files/' + filename
-    target_filename = 'encrypted/' + filename
+    # Write the public key to a PEM file
+    with open(os.path.join(root, 'key', 'Taale_Ki_Chabhi.pem'), "wb") as public_key:
+        public_key.write(keys['key_1'])
 
-    with open(source_filename, 'rb') as file:
+def seal_piece(index, filename, ctx, root='.'):
+    """Encrypt files/<filename> in memory; safe to run in a worker."""
+    with open(os.path.join(root, 'files', filename), 'rb') as file:
         raw = file.read()
-    secret_data = chacha.encrypt(nonce, raw, aad)
+    return ctx.encrypt(index, raw)
 
-    with open(target_filename, 'wb') as target_file:
+def encrypt_piece(index, filename, ctx, root='.'):
+    """Encrypt files/<filename> into encrypted/<filename>; safe to run in a worker.
+
+    Returns the piece's entry in the piece table.
+    """
+    secret_data = seal_piece(index, filename, ctx, root)
+    with open(os.path.join(root, 'encrypted', filename), 'wb') as target_file:
         target_file.write(secret_data)
+    return container.piece_entry(secret_data)
 
-def Algo3(filename, key, nonce):
-    aad = b"authenticated but unencrypted data"
-    aesgcm = AESGCM(key)
-    source_filename = 'files/' + filename
-    target_filename = 'encrypted/' + filename
+def encrypter(workers=1, processes=False, packed=False, raw=False, root='.', schedule=None):
+    tools.empty_folder(os.path.join(root, 'key'))
+    tools.empty_folder(os.path.join(root, 'encrypted'))
 
-    with open(source_filename, 'rb') as file:
-        raw = file.read()
-    secret_data = aesgcm.encrypt(nonce, raw, aad)
+    # Generate encryption keys and nonces, and the ciphers every piece shares
+    keys = generate_keys()
+    ctx = CipherContext(keys, raw, schedule)
 
-    with open(target_filename, 'wb') as target_file:
-        target_file.write(secret_data)
+    # Process the files in the 'files' directory
+    files = sorted(tools.list_dir(os.path.join(root, 'files')))
+    if packed:
+        # Pieces have to be appended in order, so the pool only returns them
+        seal = functools.partial(seal_piece, ctx=ctx, root=root)
+        with container.open_writer(os.path.join(root, 'encrypted'), hashed=True) as writer:
+            if workers > 1:
+                with tools.make_pool(workers, processes) as pool:
+                    for secret_data in tools.bounded_map(pool, seal, files, workers * 2):
+                        writer.add(secret_data)
+            else:
+                for index, filename in enumerate(files):
+                    writer.add(seal(index, filename))
+        table = writer.table
+    elif workers > 1:
+        # Every piece is independent, so spread them over a pool
+        with tools.make_pool(workers, processes) as pool:
+            futures = [pool.submit(encrypt_piece, index, filename, ctx, root)
+                       for index, filename in enumerate(files)]
+            table = [future.result() for future in futures]
+    else:
+        table = [encrypt_piece(index, filename, ctx, root) for index, filename in enumerate(files)]
 
-def Algo4(filename, key, nonce):
-    aad = b"authenticated but unencrypted data"
-    aesccm = AESCCM(key)
-    source_filename = 'files/' + filename
-    target_filename = 'encrypted/' + filename
+    # divide() left the metadata as text; it is sealed with the keys now
+    meta_path = os.path.join(root, 'raw_data', 'meta_data.txt')
+    meta = tools.read_meta_data(meta_path)
+    meta['schedule'] = format_schedule(ctx.schedule)
+    meta['nonces'] = ctx.nonces
+    meta['pieces'] = table
+    store_keys(keys, meta, root)
+    os.remove(meta_path)
 
-    with open(source_filename, 'rb') as file:
-        raw = file.read()
-    secret_data = aesccm.encrypt(nonce, raw, aad)
+    # Clean up the 'files' folder
+    tools.empty_folder(os.path.join(root, 'files'))
 
-    with open(target_filename, 'wb') as target_file:
-        target_file.write(secret_data)
+def encrypt_stream(FILE=None, workers=1, processes=False, chunk_size=None, packed=True, raw=False, root='.',
+                   progress=None, cdc=False, compress=None, known=None, source=None, size_hint=None,
+                   schedule=None):
+    """Divide and encrypt in one pass, without the intermediate 'files' folder.
 
-def encrypter():
-    tools.empty_folder('key')
-    tools.empty_folder('encrypted')
+    Each chapter is read from the upload, encrypted in memory and only the
+    ciphertext is written to 'encrypted', as one packed container unless
+    packed is False. With workers > 1 the chapters are encrypted on a pool
+    while the next ones are being read. Without a chunk_size the divider
+    picks one from the file size. With raw, the Fernet slot is stored as raw
+    AES-GCM ciphertext instead of base64 tokens. All folders are taken
+    relative to root, a job workspace or the app directory. progress, when
+    given, is called as progress(index, nbytes, total) after every chapter.
 
-    # Generate encryption keys
-    key_1 = Fernet.generate_key()
-    key_1_1 = Fernet.generate_key()
-    key_1_2 = Fernet.generate_key()
-    key_2 = ChaCha20Poly1305.generate_key()
-    key_3 = AESGCM.generate_key(bit_length=128)
-    key_4 = AESCCM.generate_key(bit_length=128)
+    With cdc the chapters are content-defined and convergently encrypted,
+    so equal chapters give equal pieces; the last piece is then the recipe
+    of chapter lengths and keys, sealed with the job keys. Chapters whose
+    convergent key is in known, a {key: piece digest} map of what the
+    receiver already holds, are not encrypted and left as empty pieces for
+    the sender to skip.
 
-    # Generate nonces
-    nonce13 = os.urandom(13)
-    nonce12 = os.urandom(12)
+    compress ('zlib' or 'lzma') compresses every fixed-size chapter that
+    isn't already compressed data before it is encrypted; the codec is
+    recorded in the metadata.
 
-    # Process the files in the 'files' directory
-    files = sorted(tools.list_dir('files'))
-    for index, filename in enumerate(files):
-        if index % 4 == 0:
-            Algo1_extented(filename, key_1_1, key_1_2)
-        elif index % 4 == 1:
-            Algo2(filename, key_2, nonce12)
-        elif index % 4 == 2:
-            Algo3(filename, key_3, nonce12)
+    With source, a readable stream such as an upload that is still arriving,
+    the chapters are read from it as they come in and FILE only gives the
+    file name. size_hint, e.g. the request's Content-Length, stands in for
+    the file size when picking a chunk size.
+
+    schedule is the cycle of algorithms the pieces go through (see the
+    schedule module), ciphers.ROUND_ROBIN unless given; it is recorded in
+    the metadata for the decrypter.
+
+    The key blob also gets the piece table, the length and SHA-256 of every
+    piece, which decrypter.verify() checks the pieces against.
+    """
+    tools.empty_folder(os.path.join(root, 'key'))
+    tools.empty_folder(os.path.join(root, 'encrypted'))
+    tools.empty_folder(os.path.join(root, 'raw_data'))
+
+    if FILE is None:
+        FILE = divider.upload_path(root)
+    file__name = os.path.basename(FILE)
+    file_size = os.path.getsize(FILE) if source is None else size_hint or 0
+    if chunk_size is None:
+        chunk_size = divider.adaptive_chunk_size(file_size)
+
+    keys = generate_keys()
+
+    # Set the ciphers up once for the whole job; a process pool gets the keys
+    # and rebuilds them on its side
+    ctx = CipherContext(keys, raw, schedule)
+    seal = ctx.encrypt
+
+    if cdc:
+        def done(index, nbytes):
+            if progress is not None:
+                progress(index, nbytes, None)
+
+        with container.open_writer(os.path.join(root, 'encrypted'), packed, hashed=True) as writer:
+            if source is None:
+                chapters = divider.iter_cdc_chapters(FILE)
+            else:
+                chapters = divider.iter_stream_cdc_chapters(source)
+            entries = seal_cdc_chapters(chapters, writer, workers, processes, done, known)
+            writer.add(seal(len(writer), pack_recipe(entries)))
+
+        file_size = sum(length for length, _ in entries)
+        store_keys(keys, divider.meta_data(file__name, len(entries), None, file_size, chunking='cdc',
+                                           schedule=ctx.schedule, nonces=ctx.nonces, pieces=writer.table), root)
+        return
+
+    if compress:
+        seal = functools.partial(seal_compressed, seal=seal, codec=compress)
+
+    # Chapters are memoryviews of the mapped upload, except for process pools
+    # which need something they can pickle
+    if source is None:
+        chapters = divider.iter_chapters(FILE, chunk_size, zero_copy=not processes)
+        total = -(-file_size // chunk_size)
+    else:
+        # The size is only known once the stream ends
+        sizes = []
+
+        def chapters_read():
+            for data in divider.iter_stream_chapters(source, chunk_size):
+                sizes.append(len(data))
+                yield data
+
+        chapters = chapters_read()
+        total = None
+
+    def done(index):
+        if progress is not None:
+            nbytes = min(chunk_size, file_size - index * chunk_size) if source is None else sizes[index]
+            progress(index, nbytes, total)
+
+    with container.open_writer(os.path.join(root, 'encrypted'), packed, hashed=True) as writer:
+        # A compressed chapter can be a codec byte longer than the original
+        seal_chapters(seal, chapters, writer, workers, processes, chunk_size + 1, done)
+
+    if source is not None:
+        file_size = sum(sizes)
+    store_keys(keys, divider.meta_data(file__name, len(writer), chunk_size, file_size, compression=compress,
+                                       schedule=ctx.schedule, nonces=ctx.nonces, pieces=writer.table), root)
+
+def seal_chapters(seal, chapters, writer, workers=1, processes=False, chunk_size=divider.MAX, done=None):
+    """Encrypt the chapters in order into writer, calling done(index) after each one.
+
+    With workers > 1 the chapters are encrypted on a pool while the next ones
+    are being read; otherwise one ciphertext buffer serves every chapter.
+    """
+    if workers > 1:
+        with tools.make_pool(workers, processes) as pool:
+            for secret_data in tools.bounded_map(pool, seal, chapters, workers * 2):
+                index = writer.add(secret_data)
+                if done is not None:
+                    done(index)
+    else:
+        buffer = bytearray(chunk_size + 16)
+        for index, data in enumerate(chapters):
+            writer.add(seal(index, data, out=buffer))
+            if done is not None:
+                done(index)
+
+def seal_compressed(index, data, out=None, seal=None, codec='zlib'):
+    """Compress a chapter, then encrypt it with seal; safe to run in a worker."""
+    return seal(index, compression.compress(data, codec), out)
+
+def seal_cdc_chapter(index, data, known=None):
+    """seal_convergent that also returns the chapter length; safe to run in a worker."""
+    return seal_convergent(index, data, known) + (len(data),)
+
+def seal_cdc_chapters(chapters, writer, workers=1, processes=False, done=None, known=None):
+    """Convergently encrypt the chapters in order into writer; return their (length, key) entries.
+
+    Chapters whose key is in known, a {key: piece digest} map, are left as
+    empty pieces; the piece table records the piece the receiver holds.
+    """
+    entries = []
+    seal = functools.partial(seal_cdc_chapter, known=known)
+
+    def add(key, secret_data, length):
+        if secret_data is None:
+            # Convergent pieces are the chapter and a 16 byte tag
+            index = writer.add(b'', (length + 16, known[key]))
         else:
-            Algo4(filename, key_4, nonce13)
-
-    # Encode all keys and nonces to base64 to avoid decode errors
-    secret_information = (
-        base64.urlsafe_b64encode(key_1_1).decode() + ":::::" +
-        base64.urlsafe_b64encode(key_1_2).decode() + ":::::" +
-        base64.urlsafe_b64encode(key_2).decode() + ":::::" +
-        base64.urlsafe_b64encode(key_3).decode() + ":::::" +
-        base64.urlsafe_b64encode(key_4).decode() + ":::::" +
-        base64.urlsafe_b64encode(nonce12).decode() + ":::::" +
-        base64.urlsafe_b64encode(nonce13).decode()
-    )
-
-    # Encrypt the key information and store it
-    Algo1(secret_information.encode(), key_1)
+            index = writer.add(secret_data)
+        entries.append((length, key))
+        if done is not None:
+            done(index, length)
 
-    # Write the public key to a PEM file
-    with open("./key/Taale_Ki_Chabhi.pem", "wb") as public_key:
-        public_key.write(key_1)
+    if workers > 1:
+        with tools.make_pool(workers, processes) as pool:
+            for result in tools.bounded_map(pool, seal, chapters, workers * 2):
+                add(*result)
+    else:
+        for index, data in enumerate(chapters):
+            add(*seal(index, data))
+    return entries
 
-    # Clean up the 'files' folder
-    tools.empty_folder('files')
+def encrypt_batch(FILES, workers=1, processes=False, chunk_size=None, raw=False, root='.', progress=None,
+                  compress=None, schedule=None):
+    """Encrypt many files with one set of keys into one container.
+
+    The chapters of all files go through a single pipeline and pool, file
+    after file, so a batch of small files still keeps every worker busy.
+    The pieces of each file sit next to each other in the container and
+    the manifest in the key blob records where each file starts.
+    Every file gets its own chunk size unless chunk_size is given, and
+    compress and schedule work as in encrypt_stream.
+    """
+    tools.empty_folder(os.path.join(root, 'key'))
+    tools.empty_folder(os.path.join(root, 'encrypted'))
+    tools.empty_folder(os.path.join(root, 'raw_data'))
+
+    keys = generate_keys()
+    ctx = CipherContext(keys, raw, schedule)
+    seal = ctx.encrypt
+    if compress:
+        seal = functools.partial(seal_compressed, seal=seal, codec=compress)
+
+    entries = []
+    for FILE in FILES:
+        file_size = os.path.getsize(FILE)
+        size = chunk_size or divider.adaptive_chunk_size(file_size)
+        entries.append({'File_Name': os.path.basename(FILE), 'first': sum(e['chapters'] for e in entries),
+                        'chapters': -(-file_size // size), 'chunk_size': size, 'file_size': file_size})
+    total = sum(entry['chapters'] for entry in entries)
+
+    # Plaintext length of every chapter, for the progress callback
+    lengths = []
+
+    def chapters():
+        for FILE, entry in zip(FILES, entries):
+            for data in divider.iter_chapters(FILE, entry['chunk_size'], zero_copy=not processes):
+                lengths.append(len(data))
+                yield data
+
+    def done(index):
+        if progress is not None:
+            progress(index, lengths[index], total)
+
+    largest = max([entry['chunk_size'] for entry in entries] or [divider.MAX])
+    with container.open_writer(os.path.join(root, 'encrypted'), hashed=True) as writer:
+        seal_chapters(seal, chapters(), writer, workers, processes, largest + 1, done)
+
+    store_keys(keys, divider.manifest(entries, compression=compress, schedule=ctx.schedule, nonces=ctx.nonces,
+                                      pieces=writer.table), root)
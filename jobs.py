@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+import concurrent.futures
+
+class JobCancelled(Exception):
+    """Raised inside a job's pipeline once the job has been cancelled."""
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when too many jobs are already waiting."""
+
+class Job:
+    """State and progress of one background share/receive job."""
+
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.pieces_done = 0
+        self.pieces_total = None
+        self.bytes_done = 0
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.held = None
+        self.discard = None
+        self.cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def progress(self, index, nbytes, total=None):
+        """Progress callback for the pipelines: one more piece of nbytes is done."""
+        if self.cancelled.is_set():
+            raise JobCancelled(f"Job {self.id} was cancelled")
+        with self._lock:
+            self.pieces_done += 1
+            self.bytes_done += nbytes
+            if total is not None:
+                self.pieces_total = total
+
+    def cancel(self):
+        """Ask the job to stop; it does so at its next piece."""
+        self.cancelled.set()
+        if self.status == 'queued':
+            self.status = 'cancelled'
+
+    def snapshot(self):
+        """Return the job as a JSON friendly dict."""
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started if self.started else 0.0
+            info = {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'pieces_done': self.pieces_done,
+                'pieces_total': self.pieces_total,
+                'bytes_done': self.bytes_done,
+                'elapsed': elapsed,
+                'bytes_per_second': self.bytes_done / elapsed if elapsed > 0 else 0.0,
+            }
+        if self.status == 'done':
+            info['result'] = self.result
+        elif self.status == 'failed':
+            info['message'] = self.error
+        return info
+
+class JobQueue:
+    """A bounded pool of worker threads running jobs in the background.
+
+    At most `workers` jobs run at once and at most `max_pending` wait for a
+    free worker; further submissions raise QueueFull. Finished jobs are
+    forgotten after `keep_seconds`.
+    """
+
+    def __init__(self, workers=2, max_pending=32, keep_seconds=3600):
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+
+    def submit(self, kind, fn, *args, on_discard=None, hold=None, **kwargs):
+        """Queue fn(job, *args, **kwargs) and return its Job right away.
+
+        on_discard, e.g. the cleanup of the job's workspace, is called once
+        the job is over however it ends, also when it is cancelled before
+        fn ever ran. hold is what the result of a finished job points into,
+        such as the workspace its output is served from; it stays in
+        job.held and on_discard waits until the job is forgotten.
+        """
+        job = Job(kind)
+        job.held = hold
+        with self._lock:
+            discards = self._forget_old()
+            pending = sum(1 for j in self.jobs.values() if j.status == 'queued')
+            if pending >= self.max_pending:
+                raise QueueFull("Too many jobs waiting, try again later")
+            self.jobs[job.id] = job
+        self._discard(discards)
+        self._pool.submit(self._run, job, fn, args, kwargs, on_discard)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            discards = self._forget_old()
+            job = self.jobs.get(job_id)
+        self._discard(discards)
+        return job
+
+    def _run(self, job, fn, args, kwargs, on_discard=None):
+        try:
+            if job.cancelled.is_set():
+                job.status = 'cancelled'
+                job.finished = time.time()
+                return
+            job.status = 'running'
+            job.started = time.time()
+            try:
+                job.result = fn(job, *args, **kwargs)
+                job.status = 'done'
+            except JobCancelled:
+                job.status = 'cancelled'
+            except Exception as e:
+                # The pipelines wrap a cancellation in their own errors
+                job.status = 'cancelled' if job.cancelled.is_set() else 'failed'
+                job.error = str(e)
+            finally:
+                job.finished = time.time()
+        finally:
+            if job.held is not None and job.status == 'done':
+                job.discard = on_discard
+            else:
+                job.held = None
+                if on_discard is not None:
+                    on_discard()
+
+    def _forget_old(self):
+        """Drop the jobs finished more than keep_seconds ago; return their pending discards."""
+        now = time.time()
+        discards = []
+        for job_id, job in list(self.jobs.items()):
+            if job.finished and now - job.finished > self.keep_seconds:
+                del self.jobs[job_id]
+                if job.discard is not None:
+                    discards.append(job.discard)
+        return discards
+
+    @staticmethod
+    def _discard(discards):
+        # Outside the lock: a discard can be slow, like removing a workspace
+        for discard in discards:
+            discard()
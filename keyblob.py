@@ -0,0 +1,142 @@
+import base64
+import struct
+import compression
+from ciphers import COUNTER_NONCES, SHARED_NONCES, format_schedule, parse_schedule
+
+# Layout of the key blob, the one binary record of an archive that is sealed
+# with the user key into raw_data/store_in_me.enc:
+#
+#   header    MAGIC, version
+#   keys      the keys and nonces of KEY_FIELDS, raw and at fixed sizes
+#   options   flags, compression codec, schedule length; then the schedule.
+#             The COUNTER flag marks per-piece nonces: the nonce of piece i
+#             is derived from nonce12/nonce13 and i (ciphers.piece_nonce),
+#             so those two are the whole nonce table.
+#   files     file count; per file its first piece, piece count, chunk
+#             size, file size and name
+#   pieces    with the PIECES flag (version 2 on): piece count; per piece
+#             its ciphertext length and SHA-256, for decrypter.verify()
+#
+# It replaces the ':::::' joined base64 keys and the meta_data.txt text file,
+# so opening an archive is one unseal and one pass over fixed fields. The
+# metadata comes back as the dict of strings the text file used to give,
+# plus the piece table as a list of (length, digest) under 'pieces'.
+MAGIC = b'NPSK'
+VERSION = 2
+VERSIONS = (1, 2)  # Versions unpack() reads
+
+KEY_FIELDS = (('key_1_1', 32), ('key_1_2', 32), ('key_2', 32), ('key_3', 16), ('key_4', 16),
+              ('nonce12', 12), ('nonce13', 13))
+FERNET_KEYS = ('key_1_1', 'key_1_2')  # Kept raw in the blob, base64 in use
+
+BATCH, CDC, COUNTER, PIECES = 1, 2, 4, 8  # Flags
+
+HEADER = struct.Struct('>4sB')
+OPTIONS = struct.Struct('>BBB')
+COUNT = struct.Struct('>I')
+FILE = struct.Struct('>IIIQH')
+PIECE = struct.Struct('>I32s')
+
+CODEC_NAMES = {codec: name for name, codec in compression.CODECS.items()}
+
+def is_blob(data):
+    return data[:len(MAGIC)] == MAGIC
+
+def pack(keys, meta):
+    """Return the key blob of an archive's keys and metadata."""
+    parts = [HEADER.pack(MAGIC, VERSION)]
+    for name, size in KEY_FIELDS:
+        value = keys[name]
+        if name in FERNET_KEYS:
+            value = base64.urlsafe_b64decode(value)
+        if len(value) != size:
+            raise ValueError(f"{name} must be {size} bytes")
+        parts.append(value)
+
+    flags = (BATCH if 'batch' in meta else 0) | (CDC if meta.get('chunking') == 'cdc' else 0) \
+        | (COUNTER if meta.get('nonces') == COUNTER_NONCES else 0) | (PIECES if meta.get('pieces') else 0)
+    schedule = bytes(parse_schedule(meta.get('schedule')))
+    codec = compression.CODECS[meta['compression']] if meta.get('compression') else compression.STORED
+    parts.append(OPTIONS.pack(flags, codec, len(schedule)))
+    parts.append(schedule)
+
+    if flags & BATCH:
+        files = [(meta['File_Name.%d' % number], int(meta['first.%d' % number]),
+                  int(meta['chapters.%d' % number]), int(meta['chunk_size.%d' % number]),
+                  int(meta['file_size.%d' % number])) for number in range(int(meta['batch']))]
+    else:
+        files = [(meta['File_Name'], 0, int(meta['chapters']), int(meta.get('chunk_size', 0)),
+                  int(meta.get('file_size', 0)))]
+    parts.append(COUNT.pack(len(files)))
+    for name, first, chapters, chunk_size, file_size in files:
+        name = name.encode('utf-8')
+        parts.append(FILE.pack(first, chapters, chunk_size, file_size, len(name)))
+        parts.append(name)
+
+    if flags & PIECES:
+        parts.append(COUNT.pack(len(meta['pieces'])))
+        parts.extend(PIECE.pack(length, digest) for length, digest in meta['pieces'])
+    return b''.join(parts)
+
+def unpack(data):
+    """Return (keys, meta) from a key blob."""
+    try:
+        magic, version = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError("Not a key blob")
+        if version not in VERSIONS:
+            raise ValueError(f"Unsupported key blob version: {version}")
+        offset = HEADER.size
+        keys = {}
+        for name, size in KEY_FIELDS:
+            value = bytes(data[offset:offset + size])
+            keys[name] = base64.urlsafe_b64encode(value) if name in FERNET_KEYS else value
+            offset += size
+
+        flags, codec, length = OPTIONS.unpack_from(data, offset)
+        offset += OPTIONS.size
+        meta = {}
+        if codec != compression.STORED:
+            meta['compression'] = CODEC_NAMES[codec]
+        meta['schedule'] = format_schedule(data[offset:offset + length])
+        meta['nonces'] = COUNTER_NONCES if flags & COUNTER else SHARED_NONCES
+        offset += length
+
+        count, = COUNT.unpack_from(data, offset)
+        offset += COUNT.size
+        files = []
+        for _ in range(count):
+            first, chapters, chunk_size, file_size, length = FILE.unpack_from(data, offset)
+            offset += FILE.size
+            files.append((bytes(data[offset:offset + length]).decode('utf-8'), first, chapters,
+                          chunk_size, file_size))
+            offset += length
+
+        if flags & PIECES:
+            pieces, = COUNT.unpack_from(data, offset)
+            offset += COUNT.size
+            meta['pieces'] = [PIECE.unpack_from(data, offset + number * PIECE.size) for number in range(pieces)]
+            offset += pieces * PIECE.size
+    except (struct.error, KeyError, UnicodeDecodeError) as e:
+        raise ValueError(f"Corrupt key blob: {str(e)}")
+    if offset != len(data):
+        raise ValueError("Corrupt key blob: trailing data")
+
+    if flags & BATCH:
+        meta['batch'] = str(count)
+        for number, (name, first, chapters, chunk_size, file_size) in enumerate(files):
+            meta['File_Name.%d' % number] = name
+            for field, value in (('first', first), ('chapters', chapters), ('chunk_size', chunk_size),
+                                 ('file_size', file_size)):
+                meta['%s.%d' % (field, number)] = str(value)
+        return keys, meta
+
+    if count != 1:
+        raise ValueError("Corrupt key blob: one file expected")
+    (name, _, chapters, chunk_size, file_size), = files
+    meta.update({'File_Name': name, 'chapters': str(chapters), 'file_size': str(file_size)})
+    if flags & CDC:
+        meta['chunking'] = 'cdc'
+    else:
+        meta['chunk_size'] = str(chunk_size)
+    return keys, meta
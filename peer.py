@@ -0,0 +1,149 @@
+import base64
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import tools
+import transfer
+
+PORT = 8000
+
+class PeerError(Exception):
+    """Raised when a peer rejects or fails a transfer."""
+
+class PeerClient:
+    """Keep-alive HTTP connections to peers, shared by every request and job.
+
+    One requests.Session keeps a connection pool per peer, so pings,
+    connection tests and piece uploads reuse open connections instead of
+    setting up a new one for every call.
+    """
+
+    def __init__(self, pool_size=16, port=PORT, timeout=30):
+        self.port = port
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, peer_ip, path):
+        return f'http://{peer_ip}:{self.port}{path}'
+
+    def request(self, method, peer_ip, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, self.url(peer_ip, path), **kwargs)
+
+    def ping(self, peer_ip, timeout=5):
+        """Return True if the peer answers /ping."""
+        return self.request('GET', peer_ip, '/ping', timeout=timeout).status_code == 200
+
+    def send(self, peer_ip, fields, pieces, workers=4, progress=None, retries=5, backoff=1.0, digests=None):
+        """Push an encrypted file to a peer and return the peer's result.
+
+        fields are the transfer.FIELDS of the file and pieces a container.
+        Up to `workers` pieces are uploaded at once over the pooled
+        connections; progress(index, nbytes, total) is called per piece.
+        Pieces that fail are not fatal: after a pause the peer's bitmap is
+        fetched and only the pieces it is missing are sent again, for up to
+        `retries` rounds. With digests, the SHA-256 of the pieces, the peer
+        is first told which pieces are coming and only those it doesn't
+        already hold are sent.
+        """
+        # The transfer header is the stream format without pieces
+        header = b''.join(transfer.iter_frames(fields, []))
+        response = self.request('POST', peer_ip, '/transfers', data=header,
+                                params={'pieces': len(pieces)},
+                                headers={'Content-Type': transfer.CONTENT_TYPE})
+        transfer_id = self.check(response)['transfer_id']
+
+        missing = list(range(len(pieces)))
+        if digests:
+            status = self.check(self.request('POST', peer_ip, f'/transfers/{transfer_id}/have',
+                                             data=b''.join(digests),
+                                             headers={'Content-Type': 'application/octet-stream'}))
+            missing = transfer.PieceBitmap(len(pieces), base64.b64decode(status['bitmap'])).missing()
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+                missing = self.missing(peer_ip, transfer_id, len(pieces), missing)
+            missing = self.put_pieces(peer_ip, transfer_id, pieces, missing, workers, progress)
+            if not missing:
+                break
+        else:
+            # Nobody can resume this transfer once we give up on it
+            try:
+                self.request('DELETE', peer_ip, f'/transfers/{transfer_id}', timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+            raise PeerError(f"{len(missing)} pieces still missing after {retries} retries")
+
+        response = self.request('POST', peer_ip, f'/transfers/{transfer_id}/finish', params={'async': 1})
+        return self.wait(peer_ip, response, stall=self.timeout * (retries + 1))
+
+    def put_pieces(self, peer_ip, transfer_id, pieces, indexes, workers, progress=None):
+        """Upload the given pieces; return the indexes that failed."""
+        def put(_, index):
+            data = pieces.read(index)
+            try:
+                self.check(self.request('PUT', peer_ip, f'/transfers/{transfer_id}/pieces/{index}', data=data,
+                                        headers={'Content-Type': 'application/octet-stream'}))
+            except (requests.exceptions.RequestException, PeerError):
+                return index, None
+            return index, len(data)
+
+        failed = []
+        with tools.make_pool(workers) as pool:
+            for index, nbytes in tools.bounded_map(pool, put, indexes, workers * 2):
+                if nbytes is None:
+                    failed.append(index)
+                elif progress:
+                    progress(index, nbytes, len(pieces))
+        return failed
+
+    def missing(self, peer_ip, transfer_id, count, fallback):
+        """Return the pieces the peer's bitmap lacks, or fallback if it can't be asked."""
+        try:
+            status = self.check(self.request('GET', peer_ip, f'/transfers/{transfer_id}', timeout=5))
+        except (requests.exceptions.RequestException, PeerError):
+            return fallback
+        return transfer.PieceBitmap(count, base64.b64decode(status['bitmap'])).missing()
+
+    def wait(self, peer_ip, response, interval=0.5, stall=None):
+        """Return the result of a peer's answer, polling its job if it was accepted.
+
+        A job that makes no progress for `stall` seconds (the client timeout
+        by default) is given up on and cancelled, so a peer job stuck in
+        'running' doesn't hold the caller forever.
+        """
+        data = self.check(response)
+        if response.status_code != 202:
+            return data
+        stall = self.timeout if stall is None else stall
+        job_url = f"/jobs/{data['job_id']}"
+        done, deadline = None, time.monotonic() + stall
+        while True:
+            time.sleep(interval)
+            job = self.check(self.request('GET', peer_ip, job_url))
+            if job['status'] == 'done':
+                return job['result']
+            if job['status'] in ('failed', 'cancelled'):
+                raise PeerError(job.get('message') or f"Peer job {job['status']}")
+            if job.get('pieces_done') != done:
+                done, deadline = job.get('pieces_done'), time.monotonic() + stall
+            elif time.monotonic() > deadline:
+                try:
+                    self.request('POST', peer_ip, job_url + '/cancel', timeout=5)
+                except requests.exceptions.RequestException:
+                    pass
+                raise PeerError(f"Peer job {data['job_id']} made no progress for {stall:g} s")
+
+    @staticmethod
+    def check(response):
+        """Return the JSON body of a successful response, or raise PeerError."""
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code >= 400:
+            raise PeerError(f"Peer answered {response.status_code}: {data.get('message', response.reason)}")
+        return data
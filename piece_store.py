@@ -0,0 +1,67 @@
+import os
+import hashlib
+import shutil
+import uuid
+
+STORE = 'piece_store'
+
+def digest_file(path):
+    """Return the SHA-256 of a file's bytes."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.digest()
+
+class PieceStore:
+    """Encrypted pieces kept once, under the SHA-256 of their bytes.
+
+    Pieces of content-defined archives are convergently encrypted, so the
+    same chapter in any file or version is the same piece. Archives hard
+    link their pieces to the store, so every piece takes its disk space
+    once however many archives hold it.
+    """
+
+    def __init__(self, directory=STORE):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.directory, name[:2], name)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def link(self, digest, target):
+        """Put the stored piece at target; return False if the store lacks it."""
+        source = self.path(digest)
+        temp = f'{target}.{uuid.uuid4().hex}.part'
+        try:
+            os.link(source, temp)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # No hard links across file systems; a copy still works
+            try:
+                shutil.copyfile(source, temp)
+            except FileNotFoundError:
+                return False
+        os.replace(temp, target)
+        return True
+
+    def absorb(self, path):
+        """Add the piece at path to the store, or swap it for the stored copy; return its digest."""
+        digest = digest_file(path)
+        if not self.link(digest, path):
+            stored = self.path(digest)
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            try:
+                os.link(path, stored)
+            except FileExistsError:
+                # Another transfer stored it first
+                self.link(digest, path)
+            except OSError:
+                shutil.copyfile(path, stored + '.part')
+                os.replace(stored + '.part', stored)
+        return digest
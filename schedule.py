@@ -0,0 +1,83 @@
+import functools
+import os
+import time
+from encrypter import generate_keys
+from ciphers import CipherContext, ROUND_ROBIN
+
+# Schedule policies pick the cycle of algorithms the pieces of an archive go
+# through (see ciphers.ROUND_ROBIN). A policy is a function of raw, the
+# RAW_PIECES setting, that returns a schedule; POLICIES maps the names the
+# app config uses to them and register() adds more. The schedule an archive
+# was made with is in its metadata, so the receiver never needs the policy.
+LENGTH = 16  # Pieces in one cycle of a weighted schedule
+SAMPLE = 1024 * 256  # Bytes every algorithm encrypts in the benchmark
+ROUNDS = 5
+
+def round_robin(raw=False):
+    """The four algorithms in turn, as every archive used before schedules."""
+    return ROUND_ROBIN
+
+@functools.lru_cache(maxsize=None)
+def measure(raw=False, size=SAMPLE, rounds=ROUNDS):
+    """Return how fast this host encrypts with each slot, in MB/s.
+
+    Measured once per process, on the same CipherContext code the pieces go
+    through, so AES-NI, the library build and the raw setting all count.
+    """
+    ctx = CipherContext(generate_keys(), raw)
+    data = os.urandom(size)
+    out = bytearray(size + 16)
+    speeds = []
+    for slot in ROUND_ROBIN:
+        ctx.encrypt(slot, data, out)
+        best = float('inf')
+        for _ in range(rounds):
+            start = time.perf_counter()
+            ctx.encrypt(slot, data, out)
+            best = min(best, time.perf_counter() - start)
+        speeds.append(size / best / (1024 * 1024))
+    return tuple(speeds)
+
+def weighted(speeds, length=LENGTH):
+    """Return a schedule of `length` pieces giving each slot a share in proportion to its speed.
+
+    Every slot keeps at least one piece per cycle, so archives still mix
+    all the algorithms, and each slot's pieces are spread over the cycle.
+    """
+    spare = length - len(speeds)
+    shares = [speed / sum(speeds) * spare for speed in speeds]
+    counts = [1 + int(share) for share in shares]
+    # The pieces rounding left over go to the largest remainders
+    by_remainder = sorted(range(len(speeds)), key=lambda slot: shares[slot] - int(shares[slot]), reverse=True)
+    for slot in by_remainder[:length - sum(counts)]:
+        counts[slot] += 1
+
+    # Smooth weighted round robin: the slot furthest behind its share goes next
+    schedule, credit = [], [0] * len(counts)
+    for _ in range(length):
+        credit = [have + count for have, count in zip(credit, counts)]
+        slot = max(range(len(counts)), key=credit.__getitem__)
+        credit[slot] -= length
+        schedule.append(slot)
+    return tuple(schedule)
+
+def benchmarked(raw=False):
+    """Weight the schedule towards the algorithms this host runs fastest."""
+    return weighted(measure(raw))
+
+POLICIES = {'round_robin': round_robin, 'benchmark': benchmarked}
+
+def register(name, policy):
+    """Make a policy available by name, e.g. for the CIPHER_SCHEDULE setting."""
+    POLICIES[name] = policy
+
+def choose(policy='round_robin', raw=False):
+    """Return the schedule of a policy given by name or as a function."""
+    if not callable(policy):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown cipher schedule policy: {policy}")
+        policy = POLICIES[policy]
+    schedule = tuple(policy(raw))
+    if not schedule or any(slot not in ROUND_ROBIN for slot in schedule):
+        raise ValueError(f"Invalid cipher schedule: {schedule}")
+    return schedule
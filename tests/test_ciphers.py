@@ -0,0 +1,94 @@
+import os
+import pytest
+from cryptography.exceptions import InvalidTag
+import container
+import decrypter
+import divider
+import encrypter
+from ciphers import (CCM, COUNTER_NONCES, ROUND_ROBIN, SHARED_NONCES, CipherContext, ccm_nonce,
+                     piece_nonce)
+from encrypter import generate_keys
+
+KEYS = generate_keys()
+DATA = os.urandom(50000)
+CHUNK = 4096
+
+def test_piece_nonces_are_unique_per_slot():
+    ctx = CipherContext(KEYS, schedule=ROUND_ROBIN)
+    seen = set()
+    for index in range(4096):
+        slot = ctx.slot(index)
+        nonce = ctx.nonce(index, KEYS['nonce13'] if slot == CCM else KEYS['nonce12'])
+        assert (slot, nonce) not in seen
+        seen.add((slot, nonce))
+
+@pytest.mark.parametrize('length', [100, 65535, 65536, 2 ** 24, 2 ** 32])
+def test_shortened_ccm_nonces_are_unique(length):
+    nonces = {ccm_nonce(piece_nonce(KEYS['nonce13'], index), length) for index in range(4096)}
+    assert len(nonces) == 4096
+
+def test_piece_nonce_keeps_the_tail():
+    nonce = KEYS['nonce13']
+    assert piece_nonce(nonce, 0) == nonce
+    assert piece_nonce(nonce, 5)[8:] == nonce[8:]
+
+def test_shared_nonces_are_the_job_nonce():
+    ctx = CipherContext(KEYS, nonces=SHARED_NONCES)
+    assert ctx.nonce(0, KEYS['nonce12']) == ctx.nonce(7, KEYS['nonce12']) == KEYS['nonce12']
+
+def test_unknown_nonce_scheme():
+    with pytest.raises(ValueError):
+        CipherContext(KEYS, nonces='random')
+
+@pytest.mark.parametrize('nonces', [COUNTER_NONCES, SHARED_NONCES])
+@pytest.mark.parametrize('raw', [False, True])
+def test_pieces_round_trip(nonces, raw):
+    ctx = CipherContext(KEYS, raw=raw, nonces=nonces)
+    for index in range(8):
+        piece = ctx.encrypt(index, DATA[:1000 + index])
+        assert bytes(ctx.decrypt(index, piece)) == DATA[:1000 + index]
+
+def test_counter_piece_fails_at_another_index():
+    # Same slot, different index: the nonce differs, so the tag does not match
+    ctx = CipherContext(KEYS, schedule=(CCM,))
+    piece = ctx.encrypt(1, DATA[:1000])
+    with pytest.raises(InvalidTag):
+        ctx.decrypt(2, piece)
+
+def encrypt_file(tmp_path):
+    source = tmp_path / 'data.txt'
+    source.write_bytes(DATA)
+    root = tmp_path / 'archive'
+    encrypter.encrypt_stream(str(source), chunk_size=CHUNK, root=str(root))
+    return str(root)
+
+def test_counter_archive_round_trip(tmp_path):
+    root = encrypt_file(tmp_path)
+    assert decrypter.read_meta(root)['nonces'] == COUNTER_NONCES
+    output = str(tmp_path / 'out.txt')
+    decrypter.decrypter(output=output, root=root)
+    with open(output, 'rb') as f:
+        assert f.read() == DATA
+
+def write_shared_archive(root):
+    """Write an archive the way it was made before per-piece nonces and piece tables."""
+    for folder in ('key', 'encrypted', 'raw_data'):
+        os.makedirs(os.path.join(root, folder))
+    keys = generate_keys()
+    ctx = CipherContext(keys, nonces=SHARED_NONCES)
+    with container.open_writer(os.path.join(root, 'encrypted')) as writer:
+        for index, start in enumerate(range(0, len(DATA), CHUNK)):
+            writer.add(ctx.encrypt(index, DATA[start:start + CHUNK]))
+    encrypter.store_keys(keys, divider.meta_data('data.txt', len(writer), CHUNK, len(DATA)), root)
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_shared_archive_still_decrypts(tmp_path, workers):
+    root = str(tmp_path / 'archive')
+    write_shared_archive(root)
+    assert decrypter.read_meta(root)['nonces'] == SHARED_NONCES
+    assert decrypter.verify(root) is None
+    output = str(tmp_path / 'out.txt')
+    decrypter.decrypter(workers=workers, output=output, root=root)
+    with open(output, 'rb') as f:
+        assert f.read() == DATA
+    assert decrypter.decrypt_range(10000, 5000, root) == DATA[10000:15000]
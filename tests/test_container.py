@@ -0,0 +1,81 @@
+import os
+import pytest
+import container
+
+PIECES = [os.urandom(size) for size in (1, 100, 0, 4096, 17)]
+
+def write(directory, pieces=PIECES):
+    with container.open_writer(str(directory)) as writer:
+        for data in pieces:
+            writer.add(data)
+    return os.path.join(str(directory), container.PACK_NAME)
+
+def test_round_trip(tmp_path):
+    pieces = container.Container(write(tmp_path))
+    try:
+        assert len(pieces) == len(PIECES)
+        for index, data in enumerate(PIECES):
+            assert pieces.read(index) == data
+            assert bytes(pieces.view(index)) == data
+            assert pieces.length(index) == len(data)
+    finally:
+        pieces.close()
+
+def test_empty_container(tmp_path):
+    pieces = container.Container(write(tmp_path, []))
+    assert len(pieces) == 0
+    pieces.close()
+
+def test_hashed_writer_keeps_piece_table(tmp_path):
+    with container.open_writer(str(tmp_path), hashed=True) as writer:
+        writer.add(b'abc')
+        writer.add(b'', (19, b'\x01' * 32))
+    assert writer.table == [container.piece_entry(b'abc'), (19, b'\x01' * 32)]
+
+def test_directory_layout_round_trip(tmp_path):
+    with container.open_writer(str(tmp_path), packed=False) as writer:
+        for data in PIECES:
+            writer.add(data)
+    pieces = container.open_pieces(str(tmp_path))
+    assert [pieces.read(index) for index in range(len(pieces))] == PIECES
+    assert container.pack_directory(str(tmp_path)) == len(PIECES)
+    assert os.listdir(str(tmp_path)) == [container.PACK_NAME]
+    packed = container.open_pieces(str(tmp_path))
+    assert [packed.read(index) for index in range(len(packed))] == PIECES
+    packed.close()
+
+@pytest.mark.parametrize('cut', [0, 3, container.HEADER.size, 100, -container.TRAILER.size, -1])
+def test_truncated(tmp_path, cut):
+    path = write(tmp_path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:cut])
+    with pytest.raises(ValueError):
+        container.Container(path)
+
+def test_bad_magic(tmp_path):
+    path = write(tmp_path)
+    with open(path, 'r+b') as f:
+        f.write(b'XXXX')
+    with pytest.raises(ValueError):
+        container.Container(path)
+
+def test_index_pointing_past_the_end(tmp_path):
+    path = write(tmp_path)
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.seek(size - container.TRAILER.size)
+        f.write(container.TRAILER.pack(size, len(PIECES), container.MAGIC))
+    with pytest.raises(ValueError):
+        container.Container(path)
+
+def test_piece_outside_the_pieces(tmp_path):
+    path = write(tmp_path)
+    size = os.path.getsize(path)
+    index_offset = size - container.TRAILER.size - len(PIECES) * container.ENTRY.size
+    with open(path, 'r+b') as f:
+        f.seek(index_offset)
+        f.write(container.ENTRY.pack(index_offset - 1, 2))
+    with pytest.raises(ValueError):
+        container.Container(path)
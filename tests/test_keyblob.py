@@ -0,0 +1,63 @@
+import os
+import pytest
+import divider
+import keyblob
+from ciphers import COUNTER_NONCES
+from encrypter import generate_keys
+
+KEYS = generate_keys()
+TABLE = [(116, os.urandom(32)), (66, os.urandom(32))]
+
+def unpacked_keys(keys):
+    return {name: keys[name] for name, _ in keyblob.KEY_FIELDS}
+
+def test_round_trip_single_file():
+    meta = divider.meta_data('report.pdf', 2, 100, 150, compression='zlib', schedule=(1, 1, 2),
+                             nonces=COUNTER_NONCES, pieces=TABLE)
+    keys, unpacked = keyblob.unpack(keyblob.pack(KEYS, meta))
+    assert keys == unpacked_keys(KEYS)
+    assert unpacked == meta
+
+def test_round_trip_cdc():
+    meta = divider.meta_data('a.bin', 3, None, 5000, chunking='cdc', schedule=(0, 1, 2, 3))
+    keys, unpacked = keyblob.unpack(keyblob.pack(KEYS, meta))
+    assert unpacked == dict(meta, nonces='shared')
+
+def test_round_trip_batch():
+    entries = [{'File_Name': 'a.txt', 'first': 0, 'chapters': 2, 'chunk_size': 32768, 'file_size': 40000},
+               {'File_Name': 'ü.txt', 'first': 2, 'chapters': 1, 'chunk_size': 32768, 'file_size': 7}]
+    meta = divider.manifest(entries, schedule=(3,), nonces=COUNTER_NONCES, pieces=TABLE + [(23, b'\0' * 32)])
+    keys, unpacked = keyblob.unpack(keyblob.pack(KEYS, meta))
+    assert unpacked == meta
+
+def test_version_1_without_piece_table():
+    blob = keyblob.pack(KEYS, divider.meta_data('a', 3, 100, 250))
+    keys, meta = keyblob.unpack(blob[:4] + bytes([1]) + blob[5:])
+    assert meta['chapters'] == '3' and 'pieces' not in meta
+
+def test_wrong_key_size():
+    with pytest.raises(ValueError):
+        keyblob.pack(dict(KEYS, key_3=b'short'), divider.meta_data('a', 1, 100, 10))
+
+@pytest.mark.parametrize('blob', [b'', b'NPS', b'XXXX\x02', b'NPSK\x09'])
+def test_not_a_blob(blob):
+    with pytest.raises(ValueError):
+        keyblob.unpack(blob)
+
+def test_every_truncation_is_rejected():
+    blob = keyblob.pack(KEYS, divider.meta_data('report.pdf', 2, 100, 150, pieces=TABLE))
+    for cut in range(len(blob)):
+        with pytest.raises(ValueError):
+            keyblob.unpack(blob[:cut])
+
+def test_trailing_data():
+    blob = keyblob.pack(KEYS, divider.meta_data('a', 1, 100, 10))
+    with pytest.raises(ValueError):
+        keyblob.unpack(blob + b'\0')
+
+def test_unknown_codec():
+    blob = bytearray(keyblob.pack(KEYS, divider.meta_data('a', 1, 100, 10)))
+    options = keyblob.HEADER.size + sum(size for _, size in keyblob.KEY_FIELDS)
+    blob[options + 1] = 0xEE
+    with pytest.raises(ValueError):
+        keyblob.unpack(bytes(blob))
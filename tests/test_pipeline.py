@@ -0,0 +1,174 @@
+import os
+import pytest
+import container
+import decrypter
+import divider
+import encrypter
+import restore
+import schedule
+from ciphers import convergent_key
+
+CHUNK = 32768
+# Compressible text, then random bytes, so compression both helps and is skipped
+DATA = b'the quick brown fox jumps over the lazy dog\n' * 4000 + os.urandom(150000)
+
+def encrypt(tmp_path, data=DATA, name='archive', **kwargs):
+    source = tmp_path / f'{name}.txt'
+    source.write_bytes(data)
+    root = str(tmp_path / name)
+    kwargs.setdefault('chunk_size', None if kwargs.get('cdc') else CHUNK)
+    encrypter.encrypt_stream(str(source), root=root, **kwargs)
+    return root
+
+def decrypt(tmp_path, root, **kwargs):
+    output = str(tmp_path / 'out.txt')
+    decrypter.decrypter(output=output, root=root, **kwargs)
+    with open(output, 'rb') as f:
+        return f.read()
+
+def restored(root, **kwargs):
+    # Through files/ and restore.restore(), as archives without an output path go
+    decrypter.decrypter(root=root, **kwargs)
+    with open(restore.restore(root)['path'], 'rb') as f:
+        return f.read()
+
+WORKERS = [(1, False), (3, False), (2, True)]
+
+@pytest.mark.parametrize('packed', [True, False])
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_round_trip(tmp_path, packed, workers, processes):
+    root = encrypt(tmp_path, packed=packed, workers=workers, processes=processes)
+    assert decrypter.verify(root) == -(-len(DATA) // CHUNK)
+    assert decrypt(tmp_path, root, workers=workers, processes=processes) == DATA
+
+@pytest.mark.parametrize('packed', [True, False])
+def test_restore_through_files(tmp_path, packed):
+    root = encrypt(tmp_path, packed=packed)
+    assert restored(root, workers=2) == DATA
+
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_raw_pieces(tmp_path, workers, processes):
+    root = encrypt(tmp_path, raw=True, workers=workers, processes=processes)
+    # The Fernet slot is raw AES-GCM, not a base64 token
+    pieces = container.open_pieces(os.path.join(root, 'encrypted'))
+    assert pieces.read(0)[:1] == b'\x01'
+    pieces.close()
+    assert decrypt(tmp_path, root, workers=workers, processes=processes) == DATA
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_compressed_pieces(tmp_path, codec, workers, processes):
+    root = encrypt(tmp_path, compress=codec, workers=workers, processes=processes)
+    assert decrypter.read_meta(root)['compression'] == codec
+    assert os.path.getsize(os.path.join(root, 'encrypted', container.PACK_NAME)) < len(DATA)
+    assert decrypt(tmp_path, root, workers=workers, processes=processes) == DATA
+    assert restored(root) == DATA
+
+def read_recipe(root):
+    ctx, pieces, meta = decrypter.open_archive(root)
+    try:
+        return decrypter.read_recipe(ctx, pieces, meta), len(pieces)
+    finally:
+        pieces.close()
+
+@pytest.mark.parametrize('packed', [True, False])
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_cdc_round_trip(tmp_path, packed, workers, processes):
+    data = os.urandom(600000)
+    root = encrypt(tmp_path, data, cdc=True, packed=packed, workers=workers, processes=processes)
+    recipe, count = read_recipe(root)
+    # One piece per chapter, then the recipe
+    assert len(recipe) == count - 1 > 1
+    offset = 0
+    for start, length, key in recipe:
+        assert start == offset
+        assert key == convergent_key(data[start:start + length])
+        offset += length
+    assert offset == len(data)
+    assert decrypt(tmp_path, root, workers=workers, processes=processes) == data
+    assert restored(root) == data
+
+def test_cdc_equal_chapters_give_equal_pieces(tmp_path):
+    block = os.urandom(300000)
+    root = encrypt(tmp_path, block + block, cdc=True)
+    table = decrypter.read_meta(root)['pieces']
+    recipe, _ = read_recipe(root)
+    by_key = {}
+    for index, (_, _, key) in enumerate(recipe):
+        by_key.setdefault(key, set()).add(table[index])
+    assert len(by_key) < len(recipe)
+    assert all(len(entries) == 1 for entries in by_key.values())
+
+def test_delta_skips_known_chapters(tmp_path):
+    old = os.urandom(600000)
+    new = old[:300000] + os.urandom(1000) + old[300000:]
+    first = encrypt(tmp_path, old, name='first', cdc=True, packed=False)
+    first_recipe, _ = read_recipe(first)
+    first_table = decrypter.read_meta(first)['pieces']
+    known = {key: first_table[index][1] for index, (_, _, key) in enumerate(first_recipe)}
+    pieces = container.open_pieces(os.path.join(first, 'encrypted'))
+    first_pieces = {key: pieces.read(index) for index, (_, _, key) in enumerate(first_recipe)}
+    pieces.close()
+
+    second = encrypt(tmp_path, new, name='second', cdc=True, packed=False, known=known)
+    recipe, count = read_recipe(second)
+    table = decrypter.read_meta(second)['pieces']
+    skipped = [index for index, (_, _, key) in enumerate(recipe) if key in known]
+    assert 0 < len(skipped) < len(recipe)
+    for index in skipped:
+        key = recipe[index][2]
+        # Left empty, but the table lists the piece the receiver already holds
+        assert os.path.getsize(os.path.join(second, 'encrypted', 'SECRET%07d' % index)) == 0
+        assert table[index] == (len(first_pieces[key]), known[key])
+    with pytest.raises(ValueError):
+        decrypter.verify(second)
+
+    # The receiver fills the gaps from what it holds
+    for index in skipped:
+        with open(os.path.join(second, 'encrypted', 'SECRET%07d' % index), 'wb') as f:
+            f.write(first_pieces[recipe[index][2]])
+    assert decrypter.verify(second) == count
+    assert decrypt(tmp_path, second) == new
+
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_weighted_schedule(tmp_path, workers, processes):
+    cycle = schedule.weighted([1.0, 4.0, 2.0, 1.0])
+    assert len(cycle) == schedule.LENGTH and set(cycle) == {0, 1, 2, 3}
+    root = encrypt(tmp_path, schedule=cycle, workers=workers, processes=processes)
+    assert decrypter.read_meta(root)['schedule'] == ''.join(str(slot) for slot in cycle)
+    assert decrypt(tmp_path, root, workers=workers, processes=processes) == DATA
+
+@pytest.mark.parametrize('packed', [True, False])
+@pytest.mark.parametrize('workers, processes', WORKERS)
+def test_divide_then_encrypt(tmp_path, packed, workers, processes):
+    root = str(tmp_path / 'archive')
+    os.makedirs(os.path.join(root, 'uploads'))
+    with open(os.path.join(root, 'uploads', 'data.txt'), 'wb') as f:
+        f.write(DATA)
+    divider.divide(CHUNK, root)
+    encrypter.encrypter(workers, processes, packed, root=root, schedule=schedule.weighted([3.0, 1.0, 1.0, 1.0]))
+    assert decrypter.verify(root) == -(-len(DATA) // CHUNK)
+    assert restored(root, workers=workers, processes=processes) == DATA
+
+RANGES = [(0, 1), (0, CHUNK), (CHUNK - 5, 10), (100000, 70000), (len(DATA) - 3, 10), (len(DATA), 5), (5, 0)]
+
+@pytest.mark.parametrize('kwargs', [{}, {'compress': 'zlib'}, {'cdc': True}, {'packed': False}])
+@pytest.mark.parametrize('workers', [1, 3])
+def test_decrypt_range(tmp_path, kwargs, workers):
+    root = encrypt(tmp_path, **kwargs)
+    for offset, length in RANGES:
+        assert decrypter.decrypt_range(offset, length, root, workers) == DATA[offset:offset + length]
+
+def test_decrypt_range_negative(tmp_path):
+    root = encrypt(tmp_path)
+    with pytest.raises(ValueError):
+        decrypter.decrypt_range(-1, 10, root)
+
+def test_decrypt_range_of_divided_archive(tmp_path):
+    root = str(tmp_path / 'archive')
+    os.makedirs(os.path.join(root, 'uploads'))
+    with open(os.path.join(root, 'uploads', 'data.txt'), 'wb') as f:
+        f.write(DATA)
+    divider.divide(CHUNK, root)
+    encrypter.encrypter(root=root)
+    assert decrypter.decrypt_range(CHUNK - 5, 10, root) == DATA[CHUNK - 5:CHUNK + 5]
@@ -0,0 +1,82 @@
+import io
+import os
+import pytest
+import transfer
+
+FIELDS = {'filename': 'report.pdf', 'key': os.urandom(44), 'key_store': os.urandom(300)}
+
+class Pieces(list):
+    def read(self, index):
+        return self[index]
+
+PIECES = Pieces([os.urandom(size) for size in (17, 1, 70000)])
+
+def stream(fields=FIELDS, pieces=PIECES):
+    return b''.join(transfer.iter_frames(fields, pieces))
+
+def test_round_trip():
+    body = io.BytesIO(stream())
+    fields = transfer.read_fields(body)
+    assert fields == {name: value.encode() if isinstance(value, str) else value
+                      for name, value in FIELDS.items()}
+    assert list(transfer.iter_pieces(body)) == PIECES
+    assert body.read() == b''
+
+def test_no_pieces():
+    body = io.BytesIO(stream(pieces=Pieces()))
+    transfer.read_fields(body)
+    assert list(transfer.iter_pieces(body)) == []
+
+class Trickle(io.RawIOBase):
+    """A stream that hands out a few bytes per read, like a slow socket."""
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self.data.read(min(size, 3) if size >= 0 else 3)
+
+def test_short_reads():
+    body = Trickle(stream())
+    transfer.read_fields(body)
+    assert list(transfer.iter_pieces(body)) == PIECES
+
+def test_every_truncation_is_rejected():
+    data = stream()
+    for cut in range(0, len(data) - 1, 97):
+        body = io.BytesIO(data[:cut])
+        with pytest.raises(ValueError):
+            transfer.read_fields(body)
+            list(transfer.iter_pieces(body))
+
+def test_missing_end_marker():
+    body = io.BytesIO(stream()[:-transfer.LENGTH.size])
+    transfer.read_fields(body)
+    with pytest.raises(ValueError):
+        list(transfer.iter_pieces(body))
+
+def test_bad_magic():
+    with pytest.raises(ValueError):
+        transfer.read_fields(io.BytesIO(b'XXXX' + stream()[4:]))
+
+def test_other_version():
+    data = stream()
+    with pytest.raises(ValueError):
+        transfer.read_fields(io.BytesIO(data[:4] + bytes([transfer.VERSION + 1]) + data[5:]))
+
+def test_piece_longer_than_the_stream():
+    data = stream(pieces=Pieces())[:-transfer.LENGTH.size] + transfer.LENGTH.pack(1000) + b'abc'
+    body = io.BytesIO(data)
+    transfer.read_fields(body)
+    with pytest.raises(ValueError):
+        list(transfer.iter_pieces(body))
+
+def test_bitmap():
+    bitmap = transfer.PieceBitmap(10)
+    for index in (0, 3, 9):
+        bitmap.add(index)
+    assert len(bitmap) == 3 and 3 in bitmap and 4 not in bitmap
+    copy = transfer.PieceBitmap(10, bitmap.to_bytes())
+    assert copy.missing() == [1, 2, 4, 5, 6, 7, 8]
+    with pytest.raises(ValueError):
+        transfer.PieceBitmap(10, b'\0')
@@ -0,0 +1,136 @@
+import base64
+import importlib
+import os
+import pytest
+import container
+import decrypter
+import encrypter
+import transfer
+
+DATA = os.urandom(50000)
+CHUNK = 4096
+
+def make_archive(tmp_path, packed=True):
+    source = tmp_path / 'data.txt'
+    source.write_bytes(DATA)
+    root = str(tmp_path / 'archive')
+    encrypter.encrypt_stream(str(source), chunk_size=CHUNK, packed=packed, root=root)
+    return root
+
+def piece_path(root, index):
+    return os.path.join(root, 'encrypted', 'SECRET%07d' % index)
+
+def truncate(data):
+    return data[:-1]
+
+def flip_bit(data):
+    return data[:10] + bytes([data[10] ^ 0x01]) + data[11:]
+
+def damage_piece(root, index, damage):
+    with open(piece_path(root, index), 'rb') as f:
+        data = f.read()
+    with open(piece_path(root, index), 'wb') as f:
+        f.write(damage(data))
+
+def flip_packed_bit(root, index):
+    pieces = container.open_pieces(os.path.join(root, 'encrypted'))
+    offset = pieces.index[index][0] + 10
+    pieces.close()
+    with open(os.path.join(root, 'encrypted', container.PACK_NAME), 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)[0]
+        f.seek(offset)
+        f.write(bytes([byte ^ 0x01]))
+
+def assert_nothing_written(root, output=None):
+    files = os.path.join(root, 'files')
+    assert not os.path.isdir(files) or not os.listdir(files)
+    assert output is None or not os.path.exists(output)
+
+@pytest.mark.parametrize('packed', [True, False])
+def test_intact_archive_verifies(tmp_path, packed):
+    root = make_archive(tmp_path, packed)
+    assert decrypter.verify(root) == -(-len(DATA) // CHUNK)
+    assert decrypter.verify(root, workers=3) == -(-len(DATA) // CHUNK)
+
+@pytest.mark.parametrize('damage', [truncate, flip_bit])
+def test_damaged_piece_is_rejected(tmp_path, damage):
+    root = make_archive(tmp_path, packed=False)
+    damage_piece(root, 3, damage)
+    with pytest.raises(ValueError, match='Piece 3'):
+        decrypter.verify(root)
+    with pytest.raises(ValueError, match='Piece 3'):
+        decrypter.verify(root, workers=3)
+
+def test_flipped_bit_in_container_is_rejected(tmp_path):
+    root = make_archive(tmp_path)
+    flip_packed_bit(root, 5)
+    with pytest.raises(ValueError, match='Piece 5'):
+        decrypter.verify(root)
+
+def test_verify_pieces_checks_lengths_and_digests(tmp_path):
+    root = make_archive(tmp_path)
+    table = decrypter.read_meta(root)['pieces']
+    pieces = container.open_pieces(os.path.join(root, 'encrypted'))
+    try:
+        decrypter.verify_pieces(pieces, table)
+        with pytest.raises(ValueError):
+            decrypter.verify_pieces(pieces, table[:-1])
+        with pytest.raises(ValueError, match='Piece 2 is'):
+            decrypter.verify_pieces(pieces, table[:2] + [(table[2][0] - 1, table[2][1])] + table[3:])
+        with pytest.raises(ValueError, match='Piece 2 does not match'):
+            decrypter.verify_pieces(pieces, table[:2] + [(table[2][0], bytes(32))] + table[3:])
+    finally:
+        pieces.close()
+
+@pytest.mark.parametrize('damage', [truncate, flip_bit])
+@pytest.mark.parametrize('to_output', [True, False])
+def test_decrypter_fails_before_writing(tmp_path, damage, to_output):
+    root = make_archive(tmp_path, packed=False)
+    damage_piece(root, 7, damage)
+    output = str(tmp_path / 'out.txt') if to_output else None
+    with pytest.raises(ValueError, match='Piece 7'):
+        decrypter.decrypter(workers=2, output=output, root=root)
+    assert_nothing_written(root, output)
+
+@pytest.fixture
+def app_client(tmp_path, monkeypatch):
+    # The app keeps its folders relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    app = importlib.import_module('app')
+    return app, app.app.test_client()
+
+def begin_transfer(client, root, count):
+    with open(os.path.join(root, 'key', 'Taale_Ki_Chabhi.pem'), 'rb') as f:
+        key = f.read()
+    with open(os.path.join(root, 'raw_data', 'store_in_me.enc'), 'rb') as f:
+        key_store = f.read()
+    header = b''.join(transfer.iter_frames({'filename': 'data.txt', 'key': key, 'key_store': key_store}, []))
+    response = client.post(f'/transfers?pieces={count}', data=header, content_type=transfer.CONTENT_TYPE)
+    assert response.status_code == 200
+    return response.get_json()['transfer_id']
+
+@pytest.mark.parametrize('damage', [truncate, flip_bit])
+def test_put_piece_rejects_damaged_piece(tmp_path, app_client, damage):
+    app, client = app_client
+    root = make_archive(tmp_path, packed=False)
+    count = len(decrypter.read_meta(root)['pieces'])
+    transfer_id = begin_transfer(client, root, count)
+    workspace = app.get_transfer(transfer_id)['workspace']
+    with open(piece_path(root, 4), 'rb') as f:
+        data = f.read()
+    try:
+        response = client.put(f'/transfers/{transfer_id}/pieces/4', data=damage(data),
+                              content_type='application/octet-stream')
+        assert response.status_code == 400
+        assert os.listdir(workspace.path('encrypted')) == []
+        status = client.get(f'/transfers/{transfer_id}').get_json()
+        assert 4 in transfer.PieceBitmap(count, base64.b64decode(status['bitmap'])).missing()
+
+        response = client.put(f'/transfers/{transfer_id}/pieces/4', data=data,
+                              content_type='application/octet-stream')
+        assert response.status_code == 200
+        assert os.listdir(workspace.path('encrypted')) == ['SECRET0000004']
+    finally:
+        client.delete(f'/transfers/{transfer_id}')
+    assert not os.path.isdir('received_files') or not os.listdir('received_files')
@@ -1,5 +1,10 @@
 import os
 import shutil
+import collections
+import concurrent.futures
+import threading
+import uuid
+from werkzeug.utils import secure_filename
 
 def empty_folder(directory_name):
     """Empty the folder, removing all files and subdirectories inside it."""
@@ -17,6 +22,113 @@ def empty_folder(directory_name):
             except Exception as e:
                 print(f"Error while deleting {file_path}: {e}")
 
+def restored_name(name):
+    """Return the file name from an archive's metadata, safe to use as a path.
+
+    The name comes from the sender's key blob, so it must not lead out of
+    the folder it is restored into.
+    """
+    name = secure_filename(os.path.basename(name))
+    if not name:
+        raise ValueError("Archive has no usable file name")
+    return name
+
 def list_dir(path):
     """Return a list of files and directories in the given path."""
     return os.listdir(path)
+
+def make_pool(workers, processes=False):
+    """Return a thread pool, or a process pool when processes is True."""
+    if processes:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+def bounded_map(pool, fn, iterable, window):
+    """Like pool.map over (index, item) pairs, but with at most `window` tasks in flight.
+
+    Results are yielded in input order, so a generator of chapters is never
+    read further ahead than the pool can keep up with.
+    """
+    pending = collections.deque()
+    for index, item in enumerate(iterable):
+        pending.append(pool.submit(fn, index, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def read_meta_data(path='raw_data/meta_data.txt'):
+    """Parse the key=value lines of a meta data file into a dict."""
+    meta = {}
+    with open(path, 'r') as meta_data:
+        for row in meta_data:
+            temp = row.strip().split('=', 1)
+            if len(temp) > 1:
+                meta[temp[0]] = temp[1]
+    return meta
+
+def read_manifest(meta):
+    """Return the files of a batch's meta data as a list of dicts, or None for a single file."""
+    if 'batch' not in meta:
+        return None
+    entries = []
+    for number in range(int(meta['batch'])):
+        entry = {'File_Name': meta['File_Name.%d' % number]}
+        for name in ('first', 'chapters', 'chunk_size', 'file_size'):
+            entry[name] = int(meta['%s.%d' % (name, number)])
+        entries.append(entry)
+    return entries
+
+def write_at(path, offset, data):
+    """Write data at a fixed offset of an existing file, like pwrite(2)."""
+    if hasattr(os, 'pwrite'):
+        fd = os.open(path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+    else:
+        with open(path, 'r+b') as target_file:
+            target_file.seek(offset)
+            target_file.write(data)
+
+_buffers = threading.local()
+
+def thread_buffer(size):
+    """Return a scratch bytearray of at least `size` bytes, reused per thread."""
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) < size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+WORKSPACES = 'workspaces'
+WORKSPACE_FOLDERS = ('uploads', 'files', 'encrypted', 'key', 'raw_data', 'restored_file')
+
+class Workspace:
+    """Private working folders for one share/receive job.
+
+    Every module takes a root folder, so passing workspace.root instead of
+    the app directory keeps concurrent jobs from touching each other's
+    files. The folder is removed when the job leaves the `with` block.
+    `detached` marks a workspace whose cleanup another owner, such as a
+    background job, has taken over.
+    """
+
+    def __init__(self, job_id=None, base=WORKSPACES):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.root = os.path.join(base, self.job_id)
+        self.detached = False
+        for folder in WORKSPACE_FOLDERS:
+            os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
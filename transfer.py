@@ -0,0 +1,94 @@
+import struct
+
+# Layout of a binary transfer stream:
+#
+#   header   MAGIC, version
+#   fields   filename, key, key_store; each a length and its bytes
+#   pieces   each a length and the encrypted piece
+#   end      a zero length
+#
+# Every part is length prefixed, so the receiver can handle the stream as it
+# arrives and never needs more than one piece in memory. Encrypted pieces
+# always carry an authentication tag, so a real piece is never empty.
+MAGIC = b'NPST'
+VERSION = 2  # 2: the metadata is inside the key store
+CONTENT_TYPE = 'application/x-nps-transfer'
+FIELDS = ('filename', 'key', 'key_store')
+
+HEADER = struct.Struct('>4sB')
+LENGTH = struct.Struct('>I')
+
+def iter_frames(fields, pieces):
+    """Yield the transfer stream for a dict of FIELDS and the pieces of a container.
+
+    fields values are bytes or str; pieces is anything with len() and read(i),
+    such as container.Container.
+    """
+    yield HEADER.pack(MAGIC, VERSION)
+    for name in FIELDS:
+        value = fields[name]
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        yield LENGTH.pack(len(value)) + value
+    for index in range(len(pieces)):
+        data = pieces.read(index)
+        yield LENGTH.pack(len(data))
+        yield data
+    yield LENGTH.pack(0)
+
+def read_exact(stream, size):
+    """Read exactly size bytes from a file-like stream."""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            raise ValueError("Transfer stream ended early")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+def read_fields(stream):
+    """Read the header and fields of a transfer stream; return them as a dict of bytes."""
+    magic, version = HEADER.unpack(read_exact(stream, HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a transfer stream")
+    if version != VERSION:
+        raise ValueError(f"Unsupported transfer version: {version}")
+    fields = {}
+    for name in FIELDS:
+        length, = LENGTH.unpack(read_exact(stream, LENGTH.size))
+        fields[name] = read_exact(stream, length)
+    return fields
+
+def iter_pieces(stream):
+    """Yield the pieces that follow the fields, one at a time."""
+    while True:
+        length, = LENGTH.unpack(read_exact(stream, LENGTH.size))
+        if length == 0:
+            return
+        yield read_exact(stream, length)
+
+class PieceBitmap:
+    """One bit per piece of a transfer, set once the piece is safely stored."""
+
+    def __init__(self, count, data=None):
+        self.count = count
+        self.bits = bytearray(data) if data is not None else bytearray((count + 7) // 8)
+        if len(self.bits) != (count + 7) // 8:
+            raise ValueError("Bitmap does not match the piece count")
+
+    def add(self, index):
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+    def missing(self):
+        return [index for index in range(self.count) if index not in self]
+
+    def to_bytes(self):
+        return bytes(self.bits)
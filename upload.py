@@ -0,0 +1,108 @@
+import shutil
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NEED_DATA, Field, File, Epilogue
+
+BLOCK = 1024 * 64  # Bytes read from the request body at a time
+MAX_FIELD = 1024 * 64  # Largest plain form field accepted
+
+class MultipartStream:
+    """A multipart/form-data request body, parsed while it is read.
+
+    request.files spools the whole upload before the view runs. Here the
+    parts come out in the order the client sent them, and the data of a
+    file part is only read from the network when its consumer asks for
+    more, so memory stays at a few blocks however big the upload is. Plain
+    fields are gathered in form as they go by; fields sent after a file
+    are there once that file has been read.
+    """
+
+    def __init__(self, stream, content_type):
+        mimetype, options = parse_options_header(content_type or '')
+        if mimetype != 'multipart/form-data' or 'boundary' not in options:
+            raise ValueError("Not a multipart/form-data upload")
+        self.stream = stream
+        self.decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+        self.form = {}
+        self.part = None
+        self.ended = False
+
+    def next_event(self):
+        while True:
+            event = self.decoder.next_event()
+            if event is not NEED_DATA:
+                return event
+            if self.ended:
+                raise ValueError("Upload ended early")
+            data = self.stream.read(BLOCK)
+            self.ended = not data
+            self.decoder.receive_data(data or None)
+
+    def next_file(self):
+        """Return the next file part as an UploadPart, or None at the end of the body."""
+        if self.part is not None:
+            self.part.drain()
+            self.part = None
+        while True:
+            event = self.next_event()
+            if isinstance(event, Field):
+                self.form[event.name] = self.read_field().decode('utf-8', 'replace')
+            elif isinstance(event, File):
+                self.part = UploadPart(self, event.name, event.filename)
+                return self.part
+            elif isinstance(event, Epilogue):
+                return None
+
+    def read_field(self):
+        data = bytearray()
+        while True:
+            event = self.next_event()
+            data += event.data
+            if len(data) > MAX_FIELD:
+                raise ValueError("Form field too large")
+            if not event.more_data:
+                return bytes(data)
+
+    def finish(self):
+        """Read the rest of the body, collecting the fields after the last file read."""
+        while self.next_file() is not None:
+            pass
+
+class UploadPart:
+    """The data of one file part, read like a file as it arrives.
+
+    Everything read is also written to sink when one is set, so the upload
+    can be kept on disk while it is being processed.
+    """
+
+    def __init__(self, body, name, filename):
+        self.body = body
+        self.name = name
+        self.filename = filename
+        self.sink = None
+        self.size = 0
+        self.buffer = bytearray()
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            event = self.body.next_event()
+            self.buffer += event.data
+            self.done = not event.more_data
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.size += len(data)
+        if self.sink is not None:
+            self.sink.write(data)
+        return data
+
+    def drain(self):
+        while self.read(BLOCK):
+            pass
+
+    def save(self, path):
+        """Write the rest of the part to path and return its size."""
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(self, f, BLOCK)
+        return self.size